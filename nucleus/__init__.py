@@ -19,9 +19,70 @@ PERSONA_MOVEMENTS_CACHE_DURATION = 60 * 10
 CONVERSATION_LIST_CACHE_DURATION = 60 * 60 * 24
 
 IFRAME_URL_CACHE_DURATION = 24 * 60 * 60
+IFRAME_URL_NEGATIVE_CACHE_DURATION = 60 * 10
+
+# Maximum time (seconds) spent resolving embeds in helpers.iframe_urls
+IFRAME_URL_DEADLINE = 3.0
+
+# Values of CompressedText columns longer than this many bytes are stored
+# zlib-compressed
+TEXT_COMPRESSION_THRESHOLD = 1024
+
+# In-process cache in front of the shared cache, enabled by NEAR_CACHE in
+# the config. Entries expire after NEAR_CACHE_TTL seconds, invalidations by
+# other processes are picked up every NEAR_CACHE_SYNC_INTERVAL seconds.
+NEAR_CACHE_SIZE = 2000
+NEAR_CACHE_TTL = 10
+NEAR_CACHE_SYNC_INTERVAL = 1
+
+# Each process logs its cache metrics in this interval (seconds)
+CACHE_METRICS_LOG_INTERVAL = 60 * 15
+
+# Rows cached by BaseModel.get_many. Changed rows are expired when their
+# session commits, this bounds how long a concurrent reader may cache the
+# previous version.
+ROW_CACHE_DURATION = 60
+
+# Callers of a single-flight memoized function wait up to SINGLE_FLIGHT_WAIT
+# seconds for another caller's result before computing it themselves
+SINGLE_FLIGHT_LOCK_TIMEOUT = 60
+SINGLE_FLIGHT_WAIT = 5
+
+# Buffered upvote counts are written to the database in this interval
+# (seconds) when VOTE_WRITE_BEHIND is enabled in the config. An upvote is
+# written by the second flush after it, see helpers.CounterBuffer.
+VOTE_FLUSH_INTERVAL = 60
+
+# Maximum number of frontpage candidates stored per Persona
+TIMELINE_LENGTH = 200
 
 ATTENTION_MULT = 10
 
+# Link probing in helpers.find_links
+LINK_PROBE_TIMEOUT = 3.0
+LINK_PROBE_DEADLINE = 5.0
+LINK_PROBE_WORKERS = 8
+LINK_PROBE_HOST_LIMIT = 2
+
+# In-process username index used for mention autocompletion. Reloaded
+# after this many seconds to pick up identities created or renamed by other
+# processes.
+USERNAME_INDEX_MAX_AGE = 60 * 10
+
+URL_META_CACHE_DURATION = 24 * 60 * 60
+URL_META_NEGATIVE_CACHE_DURATION = 60 * 60
+
+# Attention received for an upvote halves every ATTENTION_HALF_LIFE seconds
+ATTENTION_HALF_LIFE = 60 * 60 * 6
+
+# Upvotes are added to an attention aggregate relative to the time it was
+# calculated. Aggregates older than this are recalculated instead.
+ATTENTION_REBASE_AGE = 60 * 60 * 24 * 7
+
+# Recalculate attention of all identities in one pass when at least this
+# many identities are out of date
+ATTENTION_BATCH_THRESHOLD = 100
+
 # Setup logger namespace
 logger = logging.getLogger('nucleus')
 
@@ -29,6 +90,9 @@ logger = logging.getLogger('nucleus')
 notification_signals = blinker.Namespace()
 movement_chat = notification_signals.signal('movement-chat')
 
+cache_signals = blinker.Namespace()
+entity_invalidated = cache_signals.signal('entity-invalidated')
+
 ALLOWED_COLORS = {
     '0b3954': "Base blue",
     'c81d25': "Accent red",
@@ -7,11 +7,19 @@
 
     :copyright: (c) 2015 by Vincent Ahrend.
 """
+import time
+import zlib
+
+from base64 import b64decode, b64encode
 from math import ceil
-from sqlalchemy import orm
+from sqlalchemy import orm, and_, event, inspect
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.session import Session, make_transient_to_detached
+from sqlalchemy.types import TypeDecorator, Text
 
-from . import ACCESS_MODES
+from . import ACCESS_MODES, TEXT_COMPRESSION_THRESHOLD, ROW_CACHE_DURATION, \
+    logger
 
 
 class BaseQuery(orm.Query):
@@ -49,6 +57,165 @@ class BaseModel(object):
             return False
         return True
 
+    @classmethod
+    def increment(cls, session, attr, delta, *criterion):
+        """Atomically add `delta` to a numeric column of all matching rows
+
+        Issues a single `UPDATE ... SET col = col + :delta` so that concurrent
+        updates don't overwrite each other. Rows where the column is NULL
+        are left at NULL. Loaded instances are not refreshed and rows cached
+        by get_many are not expired, see expire_rows.
+
+        Args:
+            session: SA session to use
+            attr: Mapped attribute of the column, e.g. `Thought._upvotes`
+            delta (int): Value to add, may be negative
+            criterion: Filter expressions selecting the rows to update
+
+        Returns:
+            int: Number of matched rows
+        """
+        column = attr.property.columns[0]
+        stmt = column.table.update() \
+            .where(and_(*criterion)) \
+            .values({column: column + delta})
+        return session.execute(stmt).rowcount
+
+    @classmethod
+    def row_key(cls, *ident):
+        # Subclasses share the key of their base table
+        return "row/{}/{}".format(
+            inspect(cls).base_mapper.local_table.name,
+            "/".join(str(part) for part in ident))
+
+    @classmethod
+    def expire_rows(cls, session, idents):
+        """Remove rows cached by get_many after `session` commits
+
+        Changes of loaded instances expire their rows by themselves. Bulk
+        updates bypass the ORM and have to expire the rows they change.
+
+        Args:
+            session: SA session that makes the changes
+            idents (iterable): Primary keys, as tuples for composite keys
+        """
+        session.info.setdefault("expired_rows", set()).update(
+            cls.row_key(*ident) if isinstance(ident, tuple)
+            else cls.row_key(ident) for ident in idents)
+
+    @classmethod
+    def get_many(cls, ids, session=None):
+        """Return instances for a list of IDs in the same order
+
+        Rows are read from the cache in one request. Missing rows are loaded
+        with one query and stored in the cache. Instances from the cache only
+        have their column values set, relationships load when accessed.
+
+        Args:
+            ids (list): Primary keys
+            session: SA session to use
+
+        Returns:
+            list: Instances, leaving out IDs that don't exist
+        """
+        from .caching import cache_metrics
+        from .connections import cache, db
+
+        if session is None:
+            session = db.session
+
+        ids = list(ids)
+        if len(ids) == 0:
+            return []
+
+        found = dict()
+        keys = [cls.row_key(id) for id in set(ids)]
+        for row in cache.get_many(*keys):
+            if row is not None:
+                inst = cls.from_row(row, session)
+                found[inst.id] = inst
+
+        missing = set(ids) - set(found.keys())
+        name = "row.{}".format(inspect(cls).base_mapper.local_table.name)
+        cache_metrics.count(name, "hits", len(found))
+        cache_metrics.count(name, "misses", len(missing))
+        if len(missing) > 0:
+            rows = dict()
+            start = time.time()
+            for inst in session.query(cls).filter(cls.id.in_(missing)):
+                found[inst.id] = inst
+                rows[inst.row_key(inst.id)] = inst.to_row()
+            cache_metrics.computed(name, time.time() - start, rows)
+            if len(rows) > 0:
+                cache.set_many(rows, timeout=ROW_CACHE_DURATION)
+
+        logger.debug("Loaded {} {} rows ({} from cache)".format(
+            len(found), cls.__name__, len(found) - len(missing)))
+        return [found[id] for id in ids if id in found]
+
+    def to_row(self):
+        """Return loaded column values of this instance for caching
+
+        Returns:
+            tuple: Mapped class and dict of column values
+        """
+        state = inspect(self)
+        return (state.mapper.class_, dict((attr.key, state.dict[attr.key])
+            for attr in state.mapper.column_attrs if attr.key in state.dict))
+
+    @classmethod
+    def from_row(cls, row, session):
+        """Return an instance for a row created by to_row without querying
+        the database
+
+        An instance already present in `session` is returned as is.
+        """
+        mapped_cls, values = row
+        inst = mapped_cls.__mapper__.class_manager.new_instance()
+        for key, value in values.iteritems():
+            set_committed_value(inst, key, value)
+        make_transient_to_detached(inst)
+        return session.merge(inst, load=False)
+
+
+class CompressedText(TypeDecorator):
+    """Text column that stores long values zlib-compressed
+
+    Values longer than TEXT_COMPRESSION_THRESHOLD bytes are compressed and
+    stored base64 encoded behind a marker prefix. Short values that happen
+    to start with the prefix are compressed as well, so they can't be
+    mistaken for compressed values.
+
+    Values without the prefix, or that fail to decompress, are returned
+    unchanged, so existing rows of a plain Text column remain readable
+    after switching its type.
+    """
+
+    impl = Text
+
+    marker = "zlib:"
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return value
+
+        encoded = value.encode('utf-8') if isinstance(value, unicode) else value
+        if len(encoded) <= TEXT_COMPRESSION_THRESHOLD \
+                and not encoded.startswith(self.marker):
+            return value
+
+        return self.marker + b64encode(zlib.compress(encoded))
+
+    def process_result_value(self, value, dialect):
+        if value is None or not value.startswith(self.marker):
+            return value
+
+        try:
+            return zlib.decompress(b64decode(value[len(self.marker):])) \
+                .decode('utf-8')
+        except (TypeError, zlib.error, UnicodeDecodeError):
+            return value
+
 
 class QueryProperty(object):
     """Query property accessor which gives a model access to query capabilities
@@ -73,3 +240,29 @@ def set_query_property(model_class, session):
     model_class.query = QueryProperty(session)
 
 Model = declarative_base(cls=BaseModel)
+
+
+@event.listens_for(Model, 'after_update', propagate=True)
+@event.listens_for(Model, 'after_delete', propagate=True)
+def expire_cached_row(mapper, connection, target):
+    """Remove rows cached by BaseModel.get_many when they change
+
+    Rows are removed when the session commits, so that concurrent readers
+    can't cache them again before the change is visible."""
+    state = inspect(target)
+    if state.identity is not None and state.session is not None:
+        target.expire_rows(state.session, [state.identity])
+
+
+@event.listens_for(Session, 'after_commit')
+def delete_expired_rows(session):
+    from .connections import cache
+
+    keys = session.info.pop("expired_rows", None)
+    if keys:
+        cache.delete_many(*keys)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_expired_rows(session):
+    session.info.pop("expired_rows", None)
@@ -0,0 +1,667 @@
+# -*- coding: utf-8 -*-
+"""
+    nucleus.caching
+    ~~~~~
+
+    Entity-versioned caching of model methods
+
+    Values memoized with `memoize_entity` are stored under a namespace made
+    of entity type, entity id and the entity's current generation. Calling
+    `invalidate_entity` increments the generation, which makes all values
+    stored for the entity unreachable at once. They expire on their own.
+
+    If NEAR_CACHE is set in the config, generations and values are also kept
+    in a small in-process cache, see NearCache.
+
+    Expensive queries that are shared by many requests use
+    `memoize_single_flight`, which recomputes an expired value only once.
+
+    Usage of all cached functions is counted in `cache_metrics`.
+
+    Both decorators accept a list of `Dependency` objects naming the models a
+    function reads. When a session commits changes to such a model, the
+    affected cached values are invalidated, see collect_invalidations.
+
+    :copyright: (c) 2015 by Vincent Ahrend.
+"""
+import cPickle as pickle
+import threading
+import time
+
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+from functools import wraps
+from hashlib import sha256
+from inspect import getargspec
+
+from flask import current_app
+from sqlalchemy import event, inspect
+from sqlalchemy.orm.session import Session
+
+from . import logger, entity_invalidated, NEAR_CACHE_SIZE, NEAR_CACHE_TTL, \
+    NEAR_CACHE_SYNC_INTERVAL, SINGLE_FLIGHT_LOCK_TIMEOUT, SINGLE_FLIGHT_WAIT, \
+    CACHE_METRICS_LOG_INTERVAL
+from .connections import cache, config, session_scope
+
+
+# Upper bounds (milliseconds) of the compute time histogram buckets
+LATENCY_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+def payload_size(value):
+    """Return the size of `value` in bytes when pickled or None"""
+    try:
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    except (pickle.PicklingError, TypeError):
+        return None
+
+
+class CacheMetrics(object):
+    """Counts usage of cached functions in this process
+
+    Every function has counters for hits, misses, stale hits and
+    invalidations, a histogram of compute times, and the total size of
+    computed values. A summary is logged every `log_interval` seconds.
+
+    Args:
+        log_interval (int): Seconds between summary log lines
+    """
+
+    events = ("hits", "misses", "stale", "invalidations")
+
+    def __init__(self, log_interval):
+        self.log_interval = log_interval
+        self.functions = dict()
+        self.lock = threading.Lock()
+        self.logged = time.time()
+
+    def _stats(self, name):
+        rv = self.functions.get(name)
+        if rv is None:
+            rv = dict((event, 0) for event in self.events)
+            rv.update(computed=0, compute_time=0.0, payload_bytes=0,
+                latency=[0] * (len(LATENCY_BUCKETS) + 1))
+            self.functions[name] = rv
+        return rv
+
+    def count(self, name, event, n=1):
+        """Add `n` to the counter of `event` for the function `name`"""
+        with self.lock:
+            self._stats(name)[event] += n
+        self.log_periodically()
+
+    def computed(self, name, seconds, value=None):
+        """Record the compute time and payload size of a cache miss
+
+        Args:
+            name (String): Function name
+            seconds (float): Time spent computing the value
+            value: Computed value, used to measure payload size
+        """
+        size = payload_size(value) if value is not None else None
+        ms = seconds * 1000
+        with self.lock:
+            stats = self._stats(name)
+            stats["computed"] += 1
+            stats["compute_time"] += seconds
+            stats["payload_bytes"] += size or 0
+            stats["latency"][bisect_left(LATENCY_BUCKETS, ms)] += 1
+        self.log_periodically()
+
+    def snapshot(self, reset=False):
+        """Return the current metrics of all functions
+
+        Args:
+            reset (Boolean): Set all counters to zero afterwards
+
+        Returns:
+            dict: For each function name a dict with the counters, `latency`
+                as list of (bucket upper bound in ms, count) with None as the
+                last bound, and the derived values `hit_ratio`,
+                `mean_compute_ms` and `mean_payload_bytes`
+        """
+        with self.lock:
+            functions = self.functions
+            if reset:
+                self.functions = dict()
+            else:
+                functions = dict((name, dict(stats, latency=list(stats["latency"])))
+                    for name, stats in functions.iteritems())
+
+        for stats in functions.itervalues():
+            requests = stats["hits"] + stats["misses"]
+            computed = stats["computed"]
+            stats["hit_ratio"] = float(stats["hits"]) / requests if requests else None
+            stats["mean_compute_ms"] = stats["compute_time"] * 1000 / computed \
+                if computed else None
+            stats["mean_payload_bytes"] = stats["payload_bytes"] / computed \
+                if computed else None
+            stats["latency"] = zip(LATENCY_BUCKETS + (None, ), stats["latency"])
+        return functions
+
+    def log_periodically(self):
+        now = time.time()
+        with self.lock:
+            if now - self.logged < self.log_interval:
+                return
+            self.logged = now
+
+        for name, stats in sorted(self.snapshot().iteritems()):
+            logger.info("Cache {}: {} hits, {} misses, {} stale, {} invalidations, "
+                "hit ratio {}, {} ms mean compute, {} bytes mean payload".format(
+                    name, stats["hits"], stats["misses"], stats["stale"],
+                    stats["invalidations"], stats["hit_ratio"],
+                    stats["mean_compute_ms"], stats["mean_payload_bytes"]))
+
+
+cache_metrics = CacheMetrics(log_interval=CACHE_METRICS_LOG_INTERVAL)
+
+
+class NearCache(object):
+    """Bounded in-process LRU cache with a short TTL
+
+    Entries may belong to a namespace. Invalidations are propagated between
+    processes with a version counter per namespace in the shared cache. Each
+    process checks the versions at most every `sync_interval` seconds and
+    clears the entries of namespaces whose version has changed. Entries
+    without a namespace are never cleared this way and must be stored under
+    keys that change with their value.
+
+    Values are stored pickled, so that every caller gets a copy of its own.
+    Values that can't be pickled are not stored.
+
+    Args:
+        name (String): Prefix of the shared version keys
+        size (int): Maximum number of entries
+        ttl (int): Seconds until an entry expires
+        sync_interval (int): Seconds between checks of the shared versions
+    """
+
+    # Version of namespaces that were not synced yet
+    unsynced = object()
+
+    def __init__(self, name, size, ttl, sync_interval):
+        self.name = name
+        self.size = size
+        self.ttl = ttl
+        self.sync_interval = sync_interval
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.versions = dict()
+        self.synced = 0
+
+    def version_key(self, namespace):
+        return "{}/version/{}".format(self.name, namespace)
+
+    def sync(self):
+        """Clear the entries of namespaces whose shared version has changed"""
+        now = time.time()
+        if now - self.synced < self.sync_interval:
+            return
+
+        with self.lock:
+            self.synced = now
+            namespaces = self.versions.keys()
+
+        if len(namespaces) == 0:
+            return
+
+        versions = cache.cache.get_many(
+            *[self.version_key(namespace) for namespace in namespaces])
+
+        with self.lock:
+            changed = set()
+            for namespace, version in zip(namespaces, versions):
+                if version != self.versions[namespace]:
+                    self.versions[namespace] = version
+                    changed.add(namespace)
+
+            if len(changed) > 0:
+                for key, entry in self.entries.items():
+                    if entry[2] in changed:
+                        del self.entries[key]
+
+    def get(self, key):
+        """Return a copy of the value stored for `key` or None"""
+        self.sync()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                return None
+
+            self.entries[key] = entry
+        return pickle.loads(entry[1])
+
+    def set(self, key, value, namespace=None):
+        try:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError):
+            return
+
+        with self.lock:
+            if namespace is not None:
+                self.versions.setdefault(namespace, self.unsynced)
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, data, namespace)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key, namespace):
+        """Remove `key` from this process and clear `namespace` in all other
+        processes"""
+        with self.lock:
+            self.entries.pop(key, None)
+
+        version_key = self.version_key(namespace)
+        if cache.cache.inc(version_key) is None:
+            cache.cache.set(version_key, 1, timeout=0)
+
+
+near_cache = NearCache("near-cache", size=NEAR_CACHE_SIZE,
+    ttl=NEAR_CACHE_TTL, sync_interval=NEAR_CACHE_SYNC_INTERVAL)
+
+
+def near_cache_enabled():
+    return config.get("NEAR_CACHE", False)
+
+
+@entity_invalidated.connect
+def expire_near_generation(entity, entity_id):
+    """Remove the invalidated generation from the near cache"""
+    if near_cache_enabled():
+        near_cache.delete(generation_key(entity, entity_id), entity)
+
+
+class Dependency(object):
+    """Declares that a cached function reads instances of a model
+
+    Args:
+        model (String): Name of the mapped class. Instances of subclasses
+            count as well.
+        target (function): Returns the entity id or a list of entity ids
+            whose cached values read a changed instance. Not needed for
+            single-flight functions without a scope.
+        attrs (tuple): Attribute names. If given, updates that change none
+            of these attributes are ignored. Inserts and deletes always count.
+    """
+
+    def __init__(self, model, target=None, attrs=None):
+        self.model = model
+        self.target = target
+        self.attrs = attrs
+
+    def changed(self, instance, session):
+        """Return True if an updated `instance` affects cached values"""
+        if self.attrs is None:
+            return session.is_modified(instance)
+
+        state = inspect(instance)
+        return any(state.attrs[attr].history.has_changes()
+            for attr in self.attrs)
+
+    def targets(self, instance):
+        """Return ids of the entities affected by a change of `instance`"""
+        rv = self.target(instance)
+        return rv if isinstance(rv, (list, tuple, set)) else [rv]
+
+
+# Cached namespaces by the name of the model they depend on, see Dependency
+dependencies = defaultdict(list)
+
+
+def register_dependencies(entity, entity_id, depends):
+    """Invalidate a namespace when instances named by `depends` change
+
+    Args:
+        entity (String): Entity type of the namespace
+        entity_id (String): Fixed entity id or None to use the targets
+            of the dependencies
+        depends (list): Dependency objects or None
+    """
+    for dependency in depends or []:
+        dependencies[dependency.model].append((entity, entity_id, dependency))
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_invalidations(session, flush_context):
+    """Remember namespaces affected by flushed changes until the session
+    commits"""
+    pending = session.info.setdefault("cache_invalidations", set())
+
+    changes = [(instance, False) for instance in session.new] \
+        + [(instance, True) for instance in session.dirty] \
+        + [(instance, False) for instance in session.deleted]
+
+    for instance, updated in changes:
+        for cls in type(instance).__mro__:
+            for entity, entity_id, dependency in dependencies.get(cls.__name__, ()):
+                if updated and not dependency.changed(instance, session):
+                    continue
+
+                if entity_id is not None:
+                    pending.add((entity, entity_id))
+                else:
+                    pending.update((entity, target_id) for target_id
+                        in dependency.targets(instance) if target_id is not None)
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_invalidations(session):
+    for entity, entity_id in session.info.pop("cache_invalidations", ()):
+        invalidate_entity(entity, entity_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_invalidations(session):
+    session.info.pop("cache_invalidations", None)
+
+
+def generation_key(entity, entity_id):
+    return "generation/{}/{}".format(entity, entity_id)
+
+
+def get_generation(entity, entity_id):
+    """Return the current generation of an entity's cache namespace
+
+    Counters missing from the cache start at the current time in
+    milliseconds, so that values stored under an evicted counter are not
+    reachable again.
+
+    Args:
+        entity (String): Entity type, e.g. 'identity'
+        entity_id (String): ID of the entity
+
+    Returns:
+        int: Generation
+    """
+    key = generation_key(entity, entity_id)
+    near = near_cache_enabled()
+    rv = near_cache.get(key) if near else None
+    if rv is not None:
+        return rv
+
+    rv = cache.cache.get(key)
+    if rv is None:
+        cache.cache.add(key, int(time.time() * 1000), timeout=0)
+        rv = cache.cache.get(key)
+
+    if near:
+        near_cache.set(key, rv, namespace=entity)
+    return rv
+
+
+def invalidate_entity(entity, entity_id):
+    """Invalidate all values memoized for an entity, see memoize_entity
+
+    Args:
+        entity (String): Entity type, e.g. 'identity'
+        entity_id (String): ID of the entity
+    """
+    # Some backends can't increment missing keys
+    if cache.cache.inc(generation_key(entity, entity_id)) is None:
+        get_generation(entity, entity_id)
+    entity_invalidated.send(entity, entity_id=entity_id)
+
+    # Single-flight functions have a namespace of their own
+    cache_metrics.count(entity_id if entity == "function" else entity,
+        "invalidations")
+    logger.debug("Invalidated cache of {} {}".format(entity, entity_id))
+
+
+def value_key(entity, entity_id, name, args, kwargs):
+    """Return the cache key of a memoized method call
+
+    A `session` keyword argument is not part of the key."""
+    params = (args, sorted((k, v) for k, v in kwargs.iteritems() if k != "session"))
+    return "{}/{}/{}/{}/{}".format(entity, entity_id,
+        get_generation(entity, entity_id), name,
+        sha256(repr(params)).hexdigest()[:16])
+
+
+def memoize_entity(entity, timeout, id_attr="id", depends=None):
+    """Decorator for memoizing a method in the cache namespace of its instance
+
+    Args:
+        entity (String): Entity type, e.g. 'identity'
+        timeout (int): Seconds until memoized values expire
+        id_attr (String): Attribute of the instance holding the entity id
+        depends (list): Dependency objects. Their `target` returns the ids of
+            the entities to invalidate.
+
+    Example:
+        class Persona(Identity):
+            @memoize_entity("identity", timeout=60, depends=[
+                Dependency("MovementMemberAssociation",
+                    target=lambda mma: mma.persona_id)])
+            def movements(self):
+                ...
+
+        invalidate_entity("identity", persona.id)
+    """
+    def decorator(f):
+        name = "{}.{}".format(entity, f.__name__)
+        register_dependencies(entity, None, depends)
+
+        @wraps(f)
+        def wrapper(self, *args, **kwargs):
+            key = value_key(entity, getattr(self, id_attr), f.__name__,
+                args, kwargs)
+
+            near = near_cache_enabled()
+
+            # Values are wrapped in a tuple to allow memoizing None
+            rv = near_cache.get(key) if near else None
+            if rv is None:
+                rv = cache.get(key)
+                if rv is None:
+                    cache_metrics.count(name, "misses")
+                    start = time.time()
+                    rv = (f(self, *args, **kwargs), )
+                    cache_metrics.computed(name, time.time() - start, rv[0])
+                    cache.set(key, rv, timeout=timeout)
+                else:
+                    cache_metrics.count(name, "hits")
+                if near:
+                    near_cache.set(key, rv)
+            else:
+                cache_metrics.count(name, "hits")
+            return rv[0]
+
+        wrapper.entity = entity
+        return wrapper
+    return decorator
+
+
+def key_part(value):
+    """Return a representation of a function argument for use in cache keys
+
+    Model instances are represented by class name and id."""
+    if isinstance(value, type):
+        return value.__name__
+    if hasattr(value, "id") and hasattr(value, "__table__"):
+        return "{}:{}".format(type(value).__name__, value.id)
+    return value
+
+
+def call_key(f, args, kwargs, scope=None):
+    """Return the cache key of calling `f` with the given arguments
+
+    A `session` keyword argument is not part of the key. See
+    memoize_single_flight for `scope`."""
+    params = ([key_part(a) for a in args], sorted((k, key_part(v))
+        for k, v in kwargs.iteritems() if k != "session"))
+    if scope is None:
+        generation = get_generation("function", f.__name__)
+    else:
+        generation = get_generation(f.__name__, scope(*args, **kwargs))
+    return "single-flight/{}.{}/{}/{}".format(f.__module__, f.__name__,
+        generation, sha256(repr(params)).hexdigest()[:16])
+
+
+class InstanceRef(object):
+    """Primary key of a model instance passed to another thread
+
+    Instances are bound to the session of the thread that loaded them.
+
+    Args:
+        instance (Model): Instance to reference
+    """
+
+    def __init__(self, instance):
+        self.cls = type(instance)
+        self.ident = inspect(instance).identity
+
+    def load(self, session):
+        """Return the referenced instance from `session`
+
+        Raises:
+            ValueError: If the instance doesn't exist anymore
+        """
+        rv = session.query(self.cls).get(self.ident)
+        if rv is None:
+            raise ValueError("{} not found".format(self))
+        return rv
+
+    def __repr__(self):
+        return "<InstanceRef {}{}>".format(self.cls.__name__, self.ident)
+
+
+def is_instance(value):
+    return not isinstance(value, type) and hasattr(value, "__table__")
+
+
+def memoize_single_flight(timeout, soft_timeout=None, depends=None,
+        scope=None):
+    """Decorator for memoizing an expensive function so that only one caller
+    at a time computes its value
+
+    Values are kept for `timeout` seconds. After `soft_timeout` seconds a
+    value is stale: it is still returned, while one caller refreshes it in
+    a background thread. When there is no value, one caller computes it
+    while the others wait for the result.
+
+    The background thread reloads model instances given as arguments by
+    their primary key in a session of its own. It passes this session to
+    `f` if `f` has a `session` argument.
+
+    Args:
+        timeout (int): Seconds until memoized values expire
+        soft_timeout (int): Seconds until memoized values are refreshed.
+            Defaults to half of `timeout`.
+        depends (list): Dependency objects. A change of any of them
+            invalidates the values of all calls, unless `scope` is given.
+        scope (function): Called with the arguments of a call. Returns the
+            id of the namespace its value is stored in. The namespaces use
+            the function name as entity type, so that dependencies can
+            invalidate them by their `target`.
+
+    Example:
+        @memoize_single_flight(timeout=60 * 60)
+        def recent_thoughts(session=None):
+            ...
+
+        refresh_memoized(recent_thoughts)
+    """
+    if soft_timeout is None:
+        soft_timeout = timeout / 2
+
+    def decorator(f):
+        name = f.__name__
+        if scope is None:
+            register_dependencies("function", name, depends)
+        else:
+            register_dependencies(name, None, depends)
+        takes_session = "session" in getargspec(f).args
+
+        def compute(key, args, kwargs):
+            start = time.time()
+            value = f(*args, **kwargs)
+            cache_metrics.computed(name, time.time() - start, value)
+            cache.set(key, (value, time.time() + soft_timeout), timeout=timeout)
+            return value
+
+        def refresh(key, app, args, kwargs):
+            try:
+                with app.app_context():
+                    with session_scope() as session:
+                        load = lambda v: v.load(session) \
+                            if isinstance(v, InstanceRef) else v
+                        args = [load(a) for a in args]
+                        kwargs = dict((k, load(v)) for k, v in kwargs.iteritems())
+                        if takes_session:
+                            kwargs["session"] = session
+                        compute(key, args, kwargs)
+            except Exception, e:
+                logger.error("Error refreshing {}: {}".format(key, e))
+            finally:
+                cache.delete(key + "/lock")
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            key = call_key(f, args, kwargs, scope)
+            lock_key = key + "/lock"
+
+            entry = cache.get(key)
+            if entry is not None:
+                value, soft_expires = entry
+                cache_metrics.count(name, "hits")
+                if soft_expires < time.time() and \
+                        cache.add(lock_key, 1, timeout=SINGLE_FLIGHT_LOCK_TIMEOUT):
+                    cache_metrics.count(name, "stale")
+                    logger.debug("Refreshing stale {}".format(key))
+
+                    # The caller's session and instances loaded from it
+                    # can't be used in another thread
+                    ref = lambda v: InstanceRef(v) if is_instance(v) else v
+                    thread = threading.Thread(target=refresh, args=(key,
+                        current_app._get_current_object(),
+                        [ref(a) for a in args],
+                        dict((k, ref(v)) for k, v in kwargs.iteritems()
+                            if k != "session")))
+                    thread.daemon = True
+                    thread.start()
+                return value
+
+            cache_metrics.count(name, "misses")
+            if cache.add(lock_key, 1, timeout=SINGLE_FLIGHT_LOCK_TIMEOUT):
+                try:
+                    return compute(key, args, kwargs)
+                finally:
+                    cache.delete(lock_key)
+
+            # Another caller is computing the value
+            deadline = time.time() + SINGLE_FLIGHT_WAIT
+            while time.time() < deadline:
+                time.sleep(0.05)
+                entry = cache.get(key)
+                if entry is not None:
+                    return entry[0]
+
+            logger.warning("Timeout waiting for {}".format(key))
+            return compute(key, args, kwargs)
+
+        wrapper.call_key = lambda *args, **kwargs: call_key(f, args, kwargs,
+            scope)
+        wrapper.compute = lambda *args, **kwargs: compute(
+            call_key(f, args, kwargs, scope), args, kwargs)
+        return wrapper
+    return decorator
+
+
+def refresh_memoized(f, *args, **kwargs):
+    """Recompute and store the value of a function decorated with
+    memoize_single_flight
+
+    Args:
+        f: Decorated function or bound method
+        args, kwargs: Arguments to call `f` with
+
+    Returns:
+        Value of calling `f`
+    """
+    if getattr(f, "__self__", None) is not None:
+        args = (f.__self__, ) + args
+        f = f.__func__
+    cache_metrics.count(f.__name__, "invalidations")
+    return f.compute(*args, **kwargs)
@@ -8,31 +8,89 @@
     :copyright: (c) 2015 by Vincent Ahrend.
 """
 import datetime
-import os
-import re
 
 import context
 import identity
 import jobs
 
 from collections import defaultdict
-from flask import url_for
+from flask import url_for, g, has_request_context
 from flask.ext.login import current_user
 from hashlib import sha256
 from uuid import uuid4
-from requests.exceptions import ConnectionError, HTTPError
-from soundcloud import Client as SoundcloudClient
 from sqlalchemy import Column, Integer, String, Boolean, DateTime, \
-    ForeignKey, Text
-from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import relationship, backref
+    ForeignKey, Text, Float, Index, event, inspect, and_, func, or_
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from sqlalchemy.orm import relationship, backref, joinedload, lazyload, \
+    with_polymorphic, deferred
+from sqlalchemy.orm.session import Session
+from sqlalchemy.orm.attributes import NO_VALUE, NEVER_SET, set_committed_value, \
+    flag_modified
 
 from . import ATTACHMENT_KINDS, logger, TOP_THOUGHT_CACHE_DURATION, \
     UPVOTE_CACHE_DURATION, ExecutionTimer, PersonaNotFoundError, \
-    UnauthorizedError, IFRAME_URL_CACHE_DURATION
-from .base import Model, BaseModel
-from .connections import cache, db
-from .helpers import process_attachments
+    UnauthorizedError, TIMELINE_LENGTH
+from .base import Model, BaseModel, CompressedText
+from .caching import memoize_entity, memoize_single_flight, Dependency, \
+    invalidate_entity
+from .connections import db, config
+from .helpers import hot_score, hot_decay, upvote_buffer, scan_attachments, \
+    build_attachments, iframe_urls
+
+
+def upvote_memo():
+    """Return upvote status of the active Persona known in this request
+
+    Returns:
+        tuple: Set of Thought IDs whose status is known and set of IDs among
+            those that have been upvoted
+        None: Outside of requests or for anonymous users
+    """
+    if not has_request_context() or current_user.is_anonymous():
+        return None
+
+    memo = getattr(g, "upvote_memo", None)
+    if memo is None:
+        memo = g.upvote_memo = dict()
+    return memo.setdefault(current_user.active_persona.id, (set(), set()))
+
+
+# Loader options for Thoughts depending on how they are displayed
+LOAD_PROFILES = {
+    # Listings only show the Thought itself
+    "list": lambda: (
+        joinedload('author'),
+        lazyload('children'),
+        lazyload('percept_assocs')),
+    # Single Thoughts show their attachments
+    "detail": lambda: (
+        joinedload('author'),
+        lazyload('children'),
+        joinedload('percept_assocs').joinedload('percept')),
+    # Conversations show attachments, replies are set by Thought.load_thread
+    "thread": lambda: (
+        joinedload('author'),
+        lazyload('children'),
+        lazyload('parent'),
+        joinedload('percept_assocs').joinedload('percept')),
+}
+
+
+def frontpage_scope(cls, persona=None, **kwargs):
+    """Return the namespace of a Thought.top_thought call"""
+    return persona.id if isinstance(persona, identity.Persona) else "anonymous"
+
+
+def frontpages_showing(thought):
+    """Return namespaces of the Thought.top_thought calls that may include
+    `thought`"""
+    session = Session.object_session(thought)
+    rv = [persona_id for (persona_id, ) in session.query(TimelineEntry.persona_id)
+        .filter(TimelineEntry.thought_id == thought.id)]
+
+    if thought.mindset is not None and thought.mindset.kind == "blog":
+        rv.append("anonymous")
+    return rv
 
 
 class Thought(Model):
@@ -45,6 +103,11 @@ class Thought(Model):
         'polymorphic_on': 'kind'
     }
 
+    __table_args__ = (
+        Index('ix_thought_mindset_hot', 'mindset_id', '_hot'),
+        Index('ix_thought_mindset_created', 'mindset_id', 'created'),
+    )
+
     id = Column(String(32), primary_key=True)
     context_length = Column(Integer(), default=3)
     created = Column(DateTime(), default=datetime.datetime.utcnow())
@@ -57,6 +120,7 @@ class Thought(Model):
     _comment_count = Column(Integer())
     _upvotes = Column(Integer())
     _blogged = Column(Boolean, default=False)
+    _hot = Column(Float(), index=True)
 
     # Relations
     author = relationship('Identity',
@@ -117,6 +181,33 @@ class Thought(Model):
                     rv = True
         return rv
 
+    def attention_recipients(self):
+        """Return Identities whose attention value includes this Thought
+
+        Returns:
+            list: The author if it is a Persona and the Movement owning this
+                Thought's mindset if it is the Movement's blog or mindspace
+        """
+        rv = list()
+        if isinstance(self.author, identity.Persona):
+            rv.append(self.author)
+
+        if self.mindset is not None \
+                and isinstance(self.mindset.author, identity.Movement) \
+                and self.mindset.kind in ("blog", "mindspace") \
+                and self.mindset.author not in rv:
+            rv.append(self.mindset.author)
+        return rv
+
+    def credit_attention(self, upvotes):
+        """Update attention of all recipients after upvote count changed
+
+        Args:
+            upvotes (int): Change in upvote count, may be negative
+        """
+        for ident in self.attention_recipients():
+            ident.add_attention(upvotes, self.created)
+
     def get_attachments(self):
         rv = defaultdict(list)
         for pa in self.percept_assocs:
@@ -149,7 +240,10 @@ class Thought(Model):
             parent=thought,
             created=thought_cloned,
             modified=thought_cloned,
-            mindset=mindset)
+            mindset=mindset,
+            _upvotes=0)
+        new_thought.update_hot()
+        new_thought.index_thread()
 
         for pa in thought.percept_assocs:
             assoc = PerceptAssociation(
@@ -158,23 +252,51 @@ class Thought(Model):
 
         return new_thought
 
+    def ancestry(self):
+        """Return IDs of this Thought and all its parents
+
+        Uses the thread index if available and walks up the parent chain
+        otherwise.
+
+        Returns:
+            list: Tuples of (thought_id, depth) with depth 0 for this Thought
+                and depth 1 for its parent
+        """
+        if len(self.ancestor_links) > 0:
+            return [(link.ancestor_id, link.depth) for link in self.ancestor_links]
+
+        rv = list()
+        thought = self
+        while thought is not None:
+            rv.append((thought.id, len(rv)))
+            thought = thought.parent
+        return rv
+
     def comment_count(self, iter=15):
         """
         Return the number of comments this Thought has receieved
 
-        Iterates up to a depth of 15 replies of self._comment_count is None
+        Counts replies up to a depth of 15 if self._comment_count is None
 
         Returns:
             Int: Number of comments
         """
         if self._comment_count is None:
-            rv = 0
-            iter = iter - 1
-            if iter > 0:
-                for comment in self.comments:
-                    if comment.state == 0:
-                        rv += comment.comment_count(iter=iter) + 1
-            self._comment_count = rv
+            if len(self.ancestor_links) > 0:
+                self._comment_count = self.subtree(max_depth=iter - 1) \
+                    .filter(Thought.state == 0) \
+                    .filter(Thought.kind == "thought") \
+                    .with_entities(func.count(Thought.id)) \
+                    .scalar()
+            else:
+                # Thread index is not available for this Thought
+                rv = 0
+                iter = iter - 1
+                if iter > 0:
+                    for comment in self.comments:
+                        if comment.state == 0:
+                            rv += comment.comment_count(iter=iter) + 1
+                self._comment_count = rv
         return self._comment_count
 
     def get_comments(self):
@@ -185,7 +307,7 @@ class Thought(Model):
     @classmethod
     def create_from_input(cls, text, author=None, longform=None,
             longform_source=None, mindset=None, parent=None,
-            extract_percepts=True):
+            extract_percepts=True, defer_percepts=None):
         """Create a new Thought object from user input
 
         Args:
@@ -197,6 +319,11 @@ class Thought(Model):
             parent (Thought): Optional parent to which this is a reply
             extract_percepts (Booleand): Option for extracting percepts from
                 longform parameter
+            defer_percepts (Boolean): Extract percepts in a background job
+                after the Thought has been stored. Defaults to the
+                ASYNC_PERCEPT_EXTRACTION config value. Notifications resulting
+                from percepts are then stored by the job instead of being
+                returned.
 
         Returns:
             dict: with keys
@@ -211,7 +338,9 @@ class Thought(Model):
         thought_created = datetime.datetime.utcnow()
         thought_id = uuid4().hex
         notifications = list()
-        percepts = set()
+
+        if defer_percepts is None:
+            defer_percepts = config.get("ASYNC_PERCEPT_EXTRACTION", False)
 
         if author is None:
             if current_user.is_anonymous():
@@ -235,31 +364,13 @@ class Thought(Model):
             modified=thought_created,
             mindset=mindset,
             _upvotes=0)
+        instance.update_hot()
 
-        if extract_percepts:
-            text, percepts = process_attachments(instance.text)
-            instance.text = text
-            logger.debug("Extracted {} percepts from title".format(len(percepts)))
+        if extract_percepts and not defer_percepts:
+            notifications.extend(instance.attach_percepts(longform=longform,
+                longform_source=longform_source))
 
-            if longform and len(longform) > 0:
-                lftext, lfpercepts = process_attachments(longform)
-                percepts = percepts.union(lfpercepts)
-                logger.debug("Extracted {} percepts from longform".format(len(percepts)))
-
-                lftext_percept = TextPercept.get_or_create(lftext,
-                    source=longform_source)
-                percepts.add(lftext_percept)
-                logger.debug("Attached longform content")
-
-            for percept in percepts:
-                if isinstance(percept, Mention):
-                    notifications.append(MentionNotification(percept,
-                        author, url_for('web.thought', id=thought_id)))
-
-                assoc = PerceptAssociation(
-                    thought=instance, percept=percept, author=author)
-                instance.percept_assocs.append(assoc)
-                logger.debug("Attached {} to new {}".format(percept, instance))
+        instance.index_thread()
 
         if parent is not None:
             parent.update_comment_count(1)
@@ -268,7 +379,20 @@ class Thought(Model):
             notifications.append(ReplyNotification(parent_thought=parent,
                 author=author, url=url_for('web.thought', id=thought_id)))
 
-        jobs.refresh_recent_thoughts.delay()
+        if extract_percepts and defer_percepts:
+            # The longform is stored right away so the job can't lose it. It
+            # keeps its attachment hints.
+            if longform and len(longform) > 0:
+                instance.percept_assocs.append(PerceptAssociation(
+                    thought=instance, author=author,
+                    percept=TextPercept.get_or_create(longform,
+                        source=longform_source)))
+
+            jobs.delay_after_commit(instance, jobs.extract_percepts,
+                thought_id, url=url_for('web.thought', id=thought_id))
+
+        if isinstance(instance.mindset, (context.Blog, context.Mindspace)):
+            jobs.delay_after_commit(instance, jobs.fan_out_thought, instance.id)
         if instance.mindset and isinstance(instance.mindset, context.Dialogue):
             jobs.refresh_conversation_lists.delay(instance.mindset.id)
 
@@ -277,9 +401,82 @@ class Thought(Model):
             "notifications": notifications
         }
 
+    def attach_percepts(self, longform=None, longform_source=None, url=None,
+            session=None, attach_longform=True):
+        """Extract percepts from this Thought's text and longform and attach
+        them to this Thought
+
+        Removes attachment hints from this Thought's text, see
+        helpers.process_attachments. Percepts found in text and longform are
+        looked up together, see PerceptResolver.
+
+        Args:
+            longform (String): Extended text of the Thought
+            longform_source (String): Source description of the longform
+            url (String): URL of this Thought used in notifications. Defaults
+                to the result of get_absolute_url.
+            session: SA session this Thought belongs to. Defaults to
+                db.session.
+            attach_longform (Boolean): Attach the longform as TextPercept. Set
+                to False if it is already attached.
+
+        Returns:
+            list: Notifications resulting from the attached percepts
+        """
+        if session is None:
+            session = db.session
+
+        notifications = list()
+        resolver = PerceptResolver()
+
+        text, attachments = scan_attachments(self.text, session=session)
+        resolver.add(attachments)
+
+        if longform and len(longform) > 0:
+            lftext, lfattachments = scan_attachments(longform, session=session)
+            resolver.add(lfattachments)
+            if attach_longform:
+                resolver.add_text(lftext, source=longform_source)
+
+        resolver.resolve(session=session)
+
+        self.text, percepts = build_attachments(text, attachments, resolver)
+        logger.debug("Extracted {} percepts from title".format(len(percepts)))
+
+        if longform and len(longform) > 0:
+            lftext, lfpercepts = build_attachments(lftext, lfattachments, resolver)
+            percepts = percepts.union(lfpercepts)
+            logger.debug("Extracted {} percepts from longform".format(len(percepts)))
+
+            if attach_longform:
+                percepts.add(resolver.get("text", lftext))
+                logger.debug("Attached longform content")
+
+        for percept in percepts:
+            if isinstance(percept, Mention):
+                notifications.append(MentionNotification(percept,
+                    self.author, url or self.get_absolute_url()))
+
+            assoc = PerceptAssociation(
+                thought=self, percept=percept, author=self.author)
+            self.percept_assocs.append(assoc)
+            logger.debug("Attached {} to new {}".format(percept, self))
+
+        return notifications
+
     def get_absolute_url(self):
         return url_for('web.thought', id=self.id)
 
+    def index_thread(self):
+        """Add this Thought to the thread index below its parent
+
+        Must be called once when a new Thought is created."""
+        self.ancestor_links.append(ThoughtClosure(ancestor_id=self.id, depth=0))
+        if self.parent is not None:
+            for ancestor_id, depth in self.parent.ancestry():
+                self.ancestor_links.append(
+                    ThoughtClosure(ancestor_id=ancestor_id, depth=depth + 1))
+
     def has_text(self):
         """Return True if this Thought has a TextPercept"""
         try:
@@ -290,20 +487,133 @@ class Thought(Model):
         return first is not None
 
     def hot(self):
-        from math import pow
-        s = self.upvote_count()
-        t = (datetime.datetime.utcnow() - self.created).total_seconds() / 3600 + 2
-        rv = (s / pow(t, 1.5))
+        return hot_decay(self.upvote_count(), self.created)
+
+    def update_hot(self):
+        """Recalculate the stored ranking score from current upvote count
+
+        Must be called whenever `_upvotes` changes. See helpers.hot_score."""
+        self._hot = hot_score(self._upvotes, self.created)
+
+    def subtree(self, max_depth=None, session=None):
+        """Return a query for all replies to this Thought and their replies
+
+        Args:
+            max_depth (int): Optional. Only include replies up to this depth
+            session: SA session to use
+
+        Returns:
+            Query: Thoughts ordered by depth, then creation time
+        """
+        if session is None:
+            session = db.session
+
+        rv = session.query(Thought) \
+            .join(ThoughtClosure, ThoughtClosure.descendant_id == Thought.id) \
+            .filter(ThoughtClosure.ancestor_id == self.id) \
+            .filter(ThoughtClosure.depth > 0)
+
+        if max_depth is not None:
+            rv = rv.filter(ThoughtClosure.depth <= max_depth)
+
+        return rv.order_by(ThoughtClosure.depth, Thought.created)
+
+    @classmethod
+    def backfill_hot(cls, session):
+        """Calculate the stored ranking score for Thoughts that are missing it
+
+        Args:
+            session: SA session to use
+
+        Returns:
+            int: Number of updated Thoughts
+        """
+        rv = 0
+        for thought in session.query(cls).filter(cls._hot == None):
+            if thought._upvotes is None:
+                thought._upvotes = thought.upvotes \
+                    .filter(Vote.state >= 0).count()
+            thought.update_hot()
+            rv += 1
+        logger.info("Calculated ranking score for {} thoughts".format(rv))
         return rv
 
     def update_comment_count(self, incr):
-        """Increment comment count by one on this thought and recurse parents"""
+        """Increment comment count on this thought and all its parents
+
+        Thoughts that don't have a comment count yet are left alone as their
+        count is calculated when it is first requested."""
         if not isinstance(incr, int):
             raise ValueError("Can only change comment count by integer values. Got {}: {}".format(type(incr), incr))
 
-        self._comment_count = self.comment_count() + incr
-        if self.parent is not None:
-            self.parent.update_comment_count(incr)
+        session = Session.object_session(self) or db.session
+        ancestors = session.query(ThoughtClosure.ancestor_id) \
+            .filter(ThoughtClosure.descendant_id == self.id)
+
+        ancestor_ids = [thought_id for (thought_id, ) in ancestors]
+
+        if len(ancestor_ids) == 0:
+            # Thread index is not available for this Thought
+            ancestor_ids = [thought_id for thought_id, depth in self.ancestry()]
+
+        Thought.increment(session, Thought._comment_count, incr,
+            Thought.id.in_(ancestor_ids))
+        Thought.expire_rows(session, ancestor_ids)
+
+        session.expire(self, ['_comment_count'])
+
+    @classmethod
+    def load_thread(cls, root_id, profile="thread", session=None):
+        """Load a Thought together with all its replies in one query
+
+        Uses the thread index and falls back to a recursive query if the root
+        Thought is not indexed. Replies to Thoughts created before the index
+        may be indexed while their root is not. The `children` and `parent` attributes
+        of all loaded Thoughts are populated without further queries.
+
+        Args:
+            root_id (String): ID of the Thought at the root of the thread
+            profile (String): Loading profile, see LOAD_PROFILES
+            session: SA session to use
+
+        Returns:
+            Thought: The root Thought
+            None: If the root Thought was not found
+        """
+        timer = ExecutionTimer()
+        if session is None:
+            session = db.session
+
+        thread = cls.query_profile(profile, session=session) \
+            .join(ThoughtClosure, ThoughtClosure.descendant_id == cls.id) \
+            .filter(ThoughtClosure.ancestor_id == root_id) \
+            .filter(or_(ThoughtClosure.depth == 0, cls.state >= 0)) \
+            .all()
+
+        if root_id not in set(thought.id for thought in thread):
+            tree = session.query(Thought.id) \
+                .filter(Thought.id == root_id) \
+                .cte(name="thread", recursive=True)
+            tree = tree.union_all(session.query(Thought.id)
+                .filter(Thought.parent_id == tree.c.id)
+                .filter(Thought.kind != "upvote")
+                .filter(Thought.state >= 0))
+            thread = cls.query_profile(profile, session=session) \
+                .join(tree, tree.c.id == cls.id) \
+                .all()
+
+        by_id = dict((thought.id, thought) for thought in thread)
+        children = defaultdict(list)
+        for thought in sorted(thread, key=lambda t: t.created):
+            if thought.parent_id in by_id and thought.id != root_id:
+                children[thought.parent_id].append(thought)
+                set_committed_value(thought, 'parent', by_id[thought.parent_id])
+
+        for thought in thread:
+            set_committed_value(thought, 'children', children[thought.id])
+
+        timer.stop("Loaded thread of {} thoughts".format(len(thread)))
+        return by_id.get(root_id)
 
     def link_url(self):
         """Return URL if this Thought has a Link-Percept
@@ -318,15 +628,39 @@ class Thought(Model):
             if percept_assoc.percept.kind == "link":
                 return percept_assoc.percept.url
 
+    @classmethod
+    def query_profile(cls, profile, session=None):
+        """Return a query for Thoughts using the given loading profile
+
+        Args:
+            profile (String): One of "list", "detail" and "thread"
+            session: SA session to use
+
+        Returns:
+            Query: Thoughts with loader options applied
+
+        Raises:
+            ValueError: For unknown profile names
+        """
+        if profile not in LOAD_PROFILES:
+            raise ValueError("Unknown loading profile '{}'".format(profile))
+
+        if session is None:
+            session = db.session
+
+        return session.query(cls).options(*LOAD_PROFILES[profile]())
+
     def get_tags(self):
         return self.percept_assocs.join(Percept).filter(Percept.kind == "tag")
 
     tags = property(get_tags)
 
     @classmethod
-    @cache.memoize(timeout=TOP_THOUGHT_CACHE_DURATION)
+    @memoize_single_flight(timeout=TOP_THOUGHT_CACHE_DURATION,
+        scope=frontpage_scope, depends=[Dependency("Thought",
+            target=frontpages_showing, attrs=("state", "_blogged"))])
     def top_thought(cls, persona=None, filter_blogged=False, session=None):
-        """Return up to 10 hottest thoughts as measured by Thought.hot
+        """Return up to 10 hottest thoughts as measured by Thought._hot
 
         Args:
             persona (Persona): Restricts the result to be from the persona's
@@ -342,7 +676,8 @@ class Thought(Model):
         if session is None:
             session = db.session
 
-        top_post_selection = session.query(cls).filter(cls.state >= 0)
+        top_post_selection = cls.query_profile("list", session=session) \
+            .filter(cls.state >= 0)
 
         if filter_blogged:
             top_post_selection = top_post_selection.filter_by(_blogged=False)
@@ -353,11 +688,14 @@ class Thought(Model):
                 .filter(context.Mindset.kind == "blog")
 
         else:
-            sources = persona.frontpage_sources()
-            top_post_selection = top_post_selection.filter(
-                Thought.mindset_id.in_(list(sources)))
+            top_post_selection = top_post_selection \
+                .join(TimelineEntry, TimelineEntry.thought_id == cls.id) \
+                .filter(TimelineEntry.persona_id == persona.id)
 
-        top_post_selection = sorted(top_post_selection, key=cls.hot, reverse=True)[:10]
+        top_post_selection = top_post_selection \
+            .filter(cls._hot != None) \
+            .order_by(cls._hot.desc()) \
+            .limit(10)
 
         rv = [t.id for t in top_post_selection]
 
@@ -365,6 +703,26 @@ class Thought(Model):
             persona if persona else "anonymous users"))
         return rv
 
+    @classmethod
+    def prefetch_upvoted(cls, thought_ids):
+        """Load whether the active Persona has upvoted the given Thoughts
+
+        Thought.upvoted answers from the result for the rest of the request.
+
+        Args:
+            thought_ids (list): IDs of Thoughts to be displayed
+        """
+        memo = upvote_memo()
+        if memo is None:
+            return
+
+        checked, upvoted = memo
+        missing = set(thought_ids) - checked
+        if len(missing) > 0:
+            upvoted.update(Vote.upvoted_ids(missing,
+                current_user.active_persona.id))
+            checked.update(missing)
+
     def upvoted(self):
         """
         Return True if active Persona has Upvoted this Thought
@@ -372,24 +730,32 @@ class Thought(Model):
         if current_user.is_anonymous():
             return False
 
-        upvote = self.upvotes.filter_by(author=current_user.active_persona).first()
+        memo = upvote_memo()
+        if memo is not None and self.id in memo[0]:
+            return self.id in memo[1]
 
-        if upvote is None or upvote.state < 0:
-            return False
-        else:
-            return True
+        upvote = Vote.query.get((current_user.active_persona.id, self.id))
+        rv = upvote is not None and upvote.state >= 0
+
+        if memo is not None:
+            memo[0].add(self.id)
+            if rv:
+                memo[1].add(self.id)
+        return rv
 
     def get_upvotes(self):
         """Returns a query for all upvotes, including disabled ones"""
-        # return self.children.filter_by(kind="upvote")
-        return Thought.query.filter_by(kind="upvote").filter_by(parent_id=self.id)
+        return Vote.query.filter_by(thought_id=self.id)
 
     upvotes = property(get_upvotes)
 
-    @cache.memoize(timeout=UPVOTE_CACHE_DURATION)
-    def upvote_count(self, session=None):
+    @memoize_entity("thought", timeout=UPVOTE_CACHE_DURATION, depends=[
+        Dependency("Vote", target=lambda vote: vote.thought_id),
+        Dependency("Thought", target=lambda thought: thought.id,
+            attrs=("_upvotes", ))])
+    def stored_upvote_count(self, session=None):
         """
-        Return the number of verified upvotes this Thought has receieved
+        Return the number of verified upvotes stored for this Thought
 
         Returns:
             Int: Number of upvotes
@@ -397,14 +763,70 @@ class Thought(Model):
         rv = self._upvotes
 
         if rv is None:
-            self._upvotes = self.upvotes.filter(Upvote.state >= 0).count()
+            self._upvotes = self.upvotes.filter(Vote.state >= 0).count()
             rv = self._upvotes
             session.add(self)
         return rv
 
+    def upvote_count(self, session=None):
+        """
+        Return the number of verified upvotes this Thought has receieved
+
+        Includes upvotes that are not written to the database yet if
+        VOTE_WRITE_BEHIND is set in the config.
+
+        Returns:
+            Int: Number of upvotes
+        """
+        rv = self.stored_upvote_count(session=session)
+        if config.get("VOTE_WRITE_BEHIND", False):
+            rv += upvote_buffer.pending(self.id)
+        return rv
+
+    def promotable(self):
+        """Return True if this Thought may be promoted to a Movement blog"""
+        return isinstance(self.mindset, context.Mindspace) \
+            and isinstance(self.mindset.author, identity.Movement)
+
+    @classmethod
+    def flush_upvotes(cls, session):
+        """Write upvote counts buffered by toggle_upvote to the database and
+        commit `session`
+
+        Args:
+            session: SA session to use
+
+        Returns:
+            dict: Change in upvote count for each updated Thought ID
+        """
+        from sqlalchemy.sql.expression import bindparam
+
+        deltas, token = upvote_buffer.collect()
+        if len(deltas) > 0:
+            t = cls.__table__
+            stmt = t.update() \
+                .where(t.c.id == bindparam("b_id")) \
+                .values(_upvotes=t.c._upvotes + bindparam("b_delta"))
+            session.execute(stmt, [dict(b_id=thought_id, b_delta=delta)
+                for thought_id, delta in deltas.iteritems()])
+            cls.expire_rows(session, deltas.keys())
+
+            for thought in session.query(cls).filter(cls.id.in_(deltas.keys())):
+                session.expire(thought, ['_upvotes'])
+                thought.update_hot()
+                thought.credit_attention(deltas[thought.id])
+
+        # Changes stay buffered if storing them fails
+        session.commit()
+        upvote_buffer.acknowledge(deltas, token)
+
+        logger.info("Flushed upvotes of {} thoughts".format(len(deltas)))
+        return deltas
+
     def text_percepts(self):
-        """Return TextPercepts of this Thought"""
-        return self.percept_assocs.join(PerceptAssociation.percept.of_type(TextPercept)).all()
+        """Return PerceptAssociations of this Thought's TextPercepts"""
+        return [pa for pa in self.percept_assocs
+            if isinstance(pa.percept, TextPercept)]
 
     def toggle_upvote(self, author_id=None):
         """
@@ -414,7 +836,7 @@ class Thought(Model):
             author_id (String): Optional Persona ID that issued the Upvote. Defaults to active Persona.
 
         Returns:
-            Upvote: The toggled upvote object
+            Vote: The toggled upvote object
 
         Raises:
             PersonaNotFoundError: Upvote author not found
@@ -435,40 +857,457 @@ class Thought(Model):
         if not author == current_user.active_persona:
             raise UnauthorizedError("Can't toggle Upvotes with foreign Persona {}".format(author))
 
-        # Check whether Upvote has been previously issued
-        upvote = self.upvotes.filter_by(author=author).first()
-        if upvote is not None:
-            if upvote.state == 0:
-                upvote.set_state(-1)
-                self._upvotes -= 1
-                logger.info("Disabling upvote by {} on {}".format(author, self))
-            else:
-                upvote.set_state(0)
-                self._upvotes += 1
-                logger.info("Enabling upvote by {} on {}".format(author, self))
-        else:
-            upvote = Upvote(id=uuid4().hex, author=author, parent=self, state=0)
-            self.children.append(upvote)
-            self._upvotes += 1
-            logger.info("Adding upvote by {} on {}".format(author, self))
-
-        # Commit Upvote
-        db.session.add(self)
+        session = db.session
         try:
-            db.session.commit()
+            delta = Vote.toggle(author.id, self.id, session)
+            logger.info("{} upvote by {} on {}".format(
+                "Enabling" if delta > 0 else "Disabling", author, self))
+
+            write_behind = config.get("VOTE_WRITE_BEHIND", False)
+            if not write_behind:
+                Thought.increment(session, Thought._upvotes, delta,
+                    Thought.id == self.id)
+                Thought.expire_rows(session, [self.id])
+                session.expire(self, ['_upvotes'])
+                self.update_hot()
+                self.credit_attention(delta)
+
+            session.add(self)
+            session.commit()
         except SQLAlchemyError:
             logger.exception("Error toggling upvote")
+            session.rollback()
         else:
-            jobs.refresh_upvote_count.delay(self.id)
+            invalidate_entity("thought", self.id)
+            if write_behind:
+                upvote_buffer.add(self.id, delta)
 
-            if upvote.state == 0 and \
-                isinstance(self.mindset, context.Mindspace) and \
-                    isinstance(self.mindset.author, context.Movement):
+            upvote = Vote.query.get((author.id, self.id))
+
+            memo = upvote_memo()
+            if memo is not None:
+                memo[0].add(self.id)
+                if upvote.state == 0:
+                    memo[1].add(self.id)
+                else:
+                    memo[1].discard(self.id)
 
+            # Buffered upvotes are counted by jobs.flush_upvote_buffer
+            if not write_behind and upvote.state == 0 and self.promotable():
                 jobs.check_promotion.delay(self.id)
             return upvote
 
 
+@event.listens_for(Thought.state, 'set', propagate=True)
+def update_attention_on_state_change(target, value, oldvalue, initiator):
+    """Remove upvotes of deleted Thoughts from their recipients' attention
+    and restore them when a Thought is undeleted"""
+    if target.created is None or not target._upvotes:
+        return
+
+    if oldvalue in (NO_VALUE, NEVER_SET):
+        if inspect(target).persistent:
+            for ident in target.attention_recipients():
+                ident._attention_dirty = True
+        return
+
+    was_visible = oldvalue is None or oldvalue >= 0
+    is_visible = value is None or value >= 0
+    if was_visible and not is_visible:
+        target.credit_attention(-target._upvotes)
+    elif is_visible and not was_visible:
+        target.credit_attention(target._upvotes)
+
+
+class ThoughtClosure(Model):
+    """Thread index linking each Thought to all its parents
+
+    Every Thought in the index is linked to itself with depth 0, to its
+    parent with depth 1, to its parent's parent with depth 2 and so on."""
+
+    __tablename__ = 'thought_closure'
+
+    ancestor_id = Column(String(32), ForeignKey('thought.id'), primary_key=True)
+    descendant_id = Column(String(32), ForeignKey('thought.id'),
+        primary_key=True, index=True)
+    depth = Column(Integer())
+
+    descendant = relationship('Thought',
+        foreign_keys=[descendant_id],
+        backref=backref('ancestor_links', cascade="all, delete-orphan"))
+
+    @classmethod
+    def rebuild(cls, session):
+        """Recreate the thread index for all Thoughts
+
+        Args:
+            session: SA session to use
+
+        Returns:
+            int: Number of indexed Thoughts
+        """
+        timer = ExecutionTimer()
+        parents = dict(session.query(Thought.id, Thought.parent_id)
+            .filter(Thought.kind != "upvote"))
+
+        session.query(cls).delete(synchronize_session=False)
+
+        rows = list()
+        for thought_id in parents:
+            ancestor_id = thought_id
+            depth = 0
+            while ancestor_id is not None and depth <= len(parents):
+                rows.append(dict(ancestor_id=ancestor_id,
+                    descendant_id=thought_id, depth=depth))
+                ancestor_id = parents.get(ancestor_id)
+                depth += 1
+
+        if len(rows) > 0:
+            session.execute(cls.__table__.insert(), rows)
+        timer.stop("Rebuilt thread index for {} thoughts".format(len(parents)))
+        return len(parents)
+
+
+class TimelineEntry(Model):
+    """Marks a Thought as a frontpage candidate for a Persona
+
+    Entries are added when a Thought is posted to a mindset the Persona
+    receives posts from (see Persona.frontpage_sources), so that frontpages
+    can be ranked from a short list instead of all Thoughts."""
+
+    __tablename__ = 'timeline_entry'
+
+    __table_args__ = (
+        Index('ix_timeline_entry_persona_created', 'persona_id', 'created'),
+    )
+
+    persona_id = Column(String(32), ForeignKey('persona.id'), primary_key=True)
+    thought_id = Column(String(32), ForeignKey('thought.id'), primary_key=True)
+    mindset_id = Column(String(32), ForeignKey('mindset.id'))
+
+    # Creation time of the Thought, used for trimming the timeline
+    created = Column(DateTime())
+    # Time the entry was added, used for finding timelines that changed
+    added = Column(DateTime(), index=True)
+
+    @classmethod
+    def followers(cls, mindset, session):
+        """Return a query for IDs of Personas that receive posts from a mindset
+
+        Args:
+            mindset (Mindset): Blog or Mindspace
+            session: SA session to use
+
+        Returns:
+            Query: Persona IDs
+        """
+        rv = session.query(identity.Persona.id) \
+            .join(identity.t_blogs_followed,
+                identity.t_blogs_followed.c.follower_id == identity.Persona.id) \
+            .filter(identity.t_blogs_followed.c.followee_id == mindset.author_id)
+
+        if mindset.kind == "mindspace":
+            mma = identity.MovementMemberAssociation
+            rv = rv.join(mma, and_(
+                mma.persona_id == identity.Persona.id,
+                mma.movement_id == mindset.author_id,
+                mma.active == True))
+        return rv
+
+    @classmethod
+    def fan_out(cls, thought, session):
+        """Add a new Thought to the timelines of all Personas receiving it
+
+        Args:
+            thought (Thought): Newly posted Thought
+            session: SA session to use
+
+        Returns:
+            int: Number of timelines the Thought was added to
+        """
+        mindset = thought.mindset
+        if mindset is None or mindset.kind not in ("blog", "mindspace"):
+            return 0
+
+        if mindset.kind == "mindspace" \
+                and not isinstance(mindset.author, identity.Movement):
+            return 0
+
+        now = datetime.datetime.utcnow()
+        rows = [dict(persona_id=persona_id, thought_id=thought.id,
+                mindset_id=mindset.id, created=thought.created, added=now)
+            for (persona_id, ) in cls.followers(mindset, session)]
+
+        rv = cls.insert_absent(rows, session)
+        logger.debug("Added {} to {} timelines".format(thought, rv))
+        return rv
+
+    @classmethod
+    def backfill(cls, persona, mindset_ids, session):
+        """Add recent Thoughts from the given mindsets to a Persona's timeline
+
+        Args:
+            persona (Persona): Owner of the timeline
+            mindset_ids (list): IDs of mindsets that were added to the
+                Persona's frontpage sources
+            session: SA session to use
+        """
+        if len(mindset_ids) == 0:
+            return
+
+        existing = session.query(cls.thought_id) \
+            .filter(cls.persona_id == persona.id) \
+            .filter(cls.mindset_id.in_(mindset_ids))
+
+        selection = session.query(Thought.id, Thought.mindset_id, Thought.created) \
+            .filter(Thought.mindset_id.in_(mindset_ids)) \
+            .filter(Thought.state >= 0) \
+            .filter(~Thought.id.in_(existing)) \
+            .order_by(Thought.created.desc()) \
+            .limit(TIMELINE_LENGTH)
+
+        now = datetime.datetime.utcnow()
+        rows = [dict(persona_id=persona.id, thought_id=thought_id,
+                mindset_id=mindset_id, created=created, added=now)
+            for thought_id, mindset_id, created in selection]
+
+        cls.insert_absent(rows, session)
+
+    @classmethod
+    def insert_absent(cls, rows, session):
+        """Insert timeline entries, leaving out those that already exist
+
+        Fan-out and backfill may add the same entry concurrently. If an
+        insert collides with such an entry, existing entries are looked up
+        again and the insert is retried once.
+
+        Args:
+            rows (list): Dicts of column values
+            session: SA session to use
+
+        Returns:
+            int: Number of inserted entries
+        """
+        for attempt in range(2):
+            if len(rows) == 0:
+                return 0
+
+            existing = set(session.query(cls.persona_id, cls.thought_id)
+                .filter(cls.persona_id.in_(set(r["persona_id"] for r in rows)))
+                .filter(cls.thought_id.in_(set(r["thought_id"] for r in rows))))
+            rows = [r for r in rows
+                if (r["persona_id"], r["thought_id"]) not in existing]
+            if len(rows) == 0:
+                return 0
+
+            try:
+                with session.begin_nested():
+                    session.execute(cls.__table__.insert(), rows)
+            except IntegrityError:
+                logger.info("Timeline entries were added concurrently")
+            else:
+                return len(rows)
+
+        logger.warning("Could not add {} timeline entries".format(len(rows)))
+        return 0
+
+    @classmethod
+    def remove(cls, persona, mindset_ids, session):
+        """Remove Thoughts from the given mindsets from a Persona's timeline
+
+        Args:
+            persona (Persona): Owner of the timeline
+            mindset_ids (list): IDs of mindsets that were removed from the
+                Persona's frontpage sources
+            session: SA session to use
+        """
+        if len(mindset_ids) == 0:
+            return
+
+        session.query(cls) \
+            .filter(cls.persona_id == persona.id) \
+            .filter(cls.mindset_id.in_(mindset_ids)) \
+            .delete(synchronize_session=False)
+
+    @classmethod
+    def rebuild(cls, persona, session):
+        """Recreate a Persona's timeline from its frontpage sources
+
+        Args:
+            persona (Persona): Owner of the timeline
+            session: SA session to use
+        """
+        session.query(cls) \
+            .filter(cls.persona_id == persona.id) \
+            .delete(synchronize_session=False)
+        cls.backfill(persona, list(persona.frontpage_sources()), session)
+
+    @classmethod
+    def trim(cls, persona_id, session):
+        """Remove all but the TIMELINE_LENGTH most recent entries of a timeline
+
+        Args:
+            persona_id (String): ID of the timeline's owner
+            session: SA session to use
+        """
+        oldest = session.query(cls.created) \
+            .filter(cls.persona_id == persona_id) \
+            .order_by(cls.created.desc()) \
+            .offset(TIMELINE_LENGTH) \
+            .limit(1) \
+            .scalar()
+
+        if oldest is not None:
+            session.query(cls) \
+                .filter(cls.persona_id == persona_id) \
+                .filter(cls.created <= oldest) \
+                .delete(synchronize_session=False)
+
+    @classmethod
+    def updated_since(cls, since, session):
+        """Return IDs of Personas whose timeline received entries since a
+        given time
+
+        Args:
+            since (datetime): Start of the timespan
+            session: SA session to use
+
+        Returns:
+            list: Persona IDs
+        """
+        return [persona_id for (persona_id, ) in session.query(cls.persona_id)
+            .filter(cls.added >= since)
+            .distinct()]
+
+
+class Vote(Model):
+    """Upvote of a Thought, which is counted while its state is 0
+
+    Votes were previously stored as Upvote objects in the Thought table, see
+    Vote.migrate_upvotes."""
+
+    __tablename__ = 'vote'
+
+    author_id = Column(String(32), ForeignKey('identity.id'), primary_key=True)
+    thought_id = Column(String(32), ForeignKey('thought.id'), primary_key=True,
+        index=True)
+
+    created = Column(DateTime(), default=datetime.datetime.utcnow)
+    modified = Column(DateTime(), default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow)
+    state = Column(Integer(), default=0)
+
+    # Relations
+    author = relationship('Identity')
+    thought = relationship('Thought',
+        backref=backref('votes', lazy="dynamic"))
+
+    def __repr__(self):
+        return "<Vote <Identity {}> -> <Thought {}> ({})>".format(
+            self.author_id[:6], self.thought_id[:6], self.state)
+
+    def get_state(self):
+        return self.state
+
+    @classmethod
+    def toggle(cls, author_id, thought_id, session):
+        """Enable an Identity's upvote on a Thought if it is disabled or
+        missing and disable it otherwise
+
+        Each step is a single atomic statement on the vote's primary key.
+
+        Args:
+            author_id (String): ID of the voting Identity
+            thought_id (String): ID of the voted Thought
+            session: SA session to use
+
+        Returns:
+            int: Resulting change in upvote count, either 1 or -1
+        """
+        now = datetime.datetime.utcnow()
+        vote = session.query(cls) \
+            .filter(cls.author_id == author_id) \
+            .filter(cls.thought_id == thought_id)
+        cls.expire_rows(session, [(author_id, thought_id)])
+
+        if vote.filter(cls.state >= 0).update(
+                {cls.state: -1, cls.modified: now},
+                synchronize_session="evaluate") > 0:
+            return -1
+
+        if vote.filter(cls.state < 0).update(
+                {cls.state: 0, cls.modified: now},
+                synchronize_session="evaluate") == 0:
+            session.add(cls(author_id=author_id, thought_id=thought_id,
+                state=0, created=now, modified=now))
+            session.flush()
+        return 1
+
+    @classmethod
+    def upvoted_ids(cls, thought_ids, author_id, session=None):
+        """Return which of the given Thoughts an Identity has upvoted
+
+        Args:
+            thought_ids (iterable): IDs of Thoughts to check
+            author_id (String): ID of the voting Identity
+            session: SA session to use
+
+        Returns:
+            set: IDs of upvoted Thoughts
+        """
+        thought_ids = list(thought_ids)
+        if len(thought_ids) == 0:
+            return set()
+
+        if session is None:
+            session = db.session
+
+        return set(thought_id for (thought_id, ) in session.query(cls.thought_id)
+            .filter(cls.author_id == author_id)
+            .filter(cls.thought_id.in_(thought_ids))
+            .filter(cls.state >= 0))
+
+    @classmethod
+    def migrate_upvotes(cls, session, delete_upvotes=False):
+        """Copy Upvote objects from the Thought table into the vote table
+
+        Upvotes of authors that already have a Vote on the same Thought are
+        skipped.
+
+        Args:
+            session: SA session to use
+            delete_upvotes (Boolean): Remove the Upvote objects afterwards
+
+        Returns:
+            int: Number of copied upvotes
+        """
+        existing = set(session.query(cls.author_id, cls.thought_id))
+        rows = dict()
+
+        upvotes = session.query(Upvote.author_id, Upvote.parent_id,
+                Upvote.state, Upvote.created, Upvote.modified) \
+            .filter(Upvote.parent_id != None) \
+            .order_by(Upvote.modified)
+
+        # Later upvotes of the same author replace earlier ones
+        for author_id, thought_id, state, created, modified in upvotes:
+            if (author_id, thought_id) not in existing:
+                rows[(author_id, thought_id)] = dict(author_id=author_id,
+                    thought_id=thought_id, state=state, created=created,
+                    modified=modified)
+
+        if len(rows) > 0:
+            session.execute(cls.__table__.insert(), rows.values())
+
+        if delete_upvotes:
+            session.query(Thought) \
+                .filter(Thought.kind == "upvote") \
+                .delete(synchronize_session=False)
+
+        logger.info("Migrated {} upvotes".format(len(rows)))
+        return len(rows)
+
+
 class PerceptAssociation(Model):
     """Associates Percepts with Thoughts, defining an author for the connection"""
 
@@ -557,7 +1396,8 @@ class TagPercept(Percept):
     def __init__(self, *args, **kwargs):
         Percept.__init__(self, *args, **kwargs)
         self.id = uuid4().hex
-        self.tag = Tag.get_or_create(kwargs["title"])
+        if self.tag is None:
+            self.tag = Tag.get_or_create(kwargs["title"])
 
     def __repr__(self):
         return "<#{} (#{}) [{}]>".format(self.title, self.tag.name, self.id[:6])
@@ -622,7 +1462,7 @@ class LinkedPicturePercept(Percept):
             ValueError: If no url was provided"""
 
         if url is not None:
-            url_hash = sha256("linkedpicture" + url).hexdigest()[:32]
+            url_hash = cls.hash_url(url)
         else:
             raise ValueError("URL parameter must not be None")
 
@@ -634,6 +1474,11 @@ class LinkedPicturePercept(Percept):
 
         return inst
 
+    @classmethod
+    def hash_url(cls, url):
+        """Return the id of the instance for `url`"""
+        return sha256("linkedpicture" + url).hexdigest()[:32]
+
 
 class LinkPercept(Percept):
     """A URL attachment"""
@@ -683,7 +1528,7 @@ class LinkPercept(Percept):
             ValueError: If no url was provided"""
 
         if url is not None:
-            url_hash = sha256(url).hexdigest()[:32]
+            url_hash = cls.hash_url(url)
         else:
             raise ValueError("URL parameter must not be None")
 
@@ -693,7 +1538,11 @@ class LinkPercept(Percept):
 
         return inst
 
-    @cache.memoize(timeout=IFRAME_URL_CACHE_DURATION)
+    @classmethod
+    def hash_url(cls, url):
+        """Return the id of the instance for `url`"""
+        return sha256(url).hexdigest()[:32]
+
     def iframe_url(self):
         """Return a URL to embed within an iframe if this link's domain provides such
 
@@ -701,32 +1550,20 @@ class LinkPercept(Percept):
             string: URL to embeddable content
             None: If no method is known to embed content from link's domain
         """
-        from urlparse import urlparse
-        rv = None
+        return iframe_urls([self.url])[self.url]
 
-        parsed_uri = urlparse(self.url)
-        if parsed_uri.netloc == "www.youtube.com":
-            # http://stackoverflow.com/a/8260383
-            youtube_re = "^.*((youtu.be\/)|(v\/)|(\/u\/\w\/)|(embed\/)|(watch\?))\??v?=?([^#\&\?]*).*"
-            matches = re.search(youtube_re, self.url)
-            if matches and matches.groups()[-1] and len(matches.groups()[-1]) == 11:
-                video_id = matches.groups()[-1]
-                rv = "https://www.youtube.com/embed/{id}".format(id=video_id)
-
-        elif parsed_uri.netloc == "soundcloud.com":
-            client_id = os.environ.get("SOUNDCLOUD_CLIENT_ID")
-            if not client_id:
-                logger.warning("Please set env var SOUNDCLOUD_CLIENT_ID to enable embeds")
-            else:
-                client = SoundcloudClient(client_id=client_id)
-                try:
-                    track = client.get('/resolve', url=self.url)
-                except (ConnectionError, HTTPError), e:
-                    logger.warning("Error connecting to Soundcloud: {}".format(e))
-                else:
-                    if track:
-                        rv = "https://w.soundcloud.com/player/?url=https%3A//api.soundcloud.com/tracks/{track_id}&amp;auto_play=false&amp;hide_related=false&amp;show_comments=true&amp;show_user=true&amp;show_reposts=false&amp;visual=true".format(track_id=track.id)
-        return rv
+    @classmethod
+    def prefetch_iframe_urls(cls, percepts):
+        """Resolve iframe URLs of many LinkPercepts concurrently, so that
+        subsequent calls to their iframe_url method are answered from cache
+
+        Args:
+            percepts (iterable): LinkPercept objects
+
+        Returns:
+            dict: Embeddable URL or None for each percept's URL
+        """
+        return iframe_urls([p.url for p in percepts])
 
 
 class TextPercept(Percept):
@@ -740,7 +1577,11 @@ class TextPercept(Percept):
 
     id = db.Column(db.String(32), db.ForeignKey('percept.id'), primary_key=True)
 
-    text = Column(Text)
+    # Only loaded when accessed
+    text = deferred(Column(CompressedText))
+
+    # Set from `text`, see update_word_count
+    word_count = Column(Integer)
 
     @classmethod
     def get_or_create(cls, text, source=None):
@@ -750,7 +1591,7 @@ class TextPercept(Percept):
             text (String): Content value of the TextPercept
             source (String): Source description, max 128 chars
         """
-        h = sha256(text.encode('utf-8')).hexdigest()[:32]
+        h = cls.hash_text(text)
         percept = TextPercept.query.get(h)
 
         if percept is None:
@@ -762,18 +1603,166 @@ class TextPercept(Percept):
 
         return percept
 
+    @classmethod
+    def hash_text(cls, text):
+        """Return the id of the instance containing `text`"""
+        return sha256(text.encode('utf-8')).hexdigest()[:32]
+
     def reading_time(self):
         """Return an estimate for reading time based on 200 words per minute
 
         Returns:
             Reading time as a timedelta object
         """
-        word_count = len(self.text.split(" "))
+        word_count = self.word_count
+        if word_count is None:
+            word_count = self.count_words(self.text)
         return datetime.timedelta(minutes=int(word_count / 200))
 
+    @classmethod
+    def backfill(cls, session):
+        """Store word count and compressed text for TextPercepts that were
+        stored without them
+
+        Args:
+            session: SA session to use
+
+        Returns:
+            int: Number of updated TextPercepts
+        """
+        rv = 0
+        for percept in session.query(cls).filter(cls.word_count == None):
+            percept.word_count = cls.count_words(percept.text)
+            flag_modified(percept, "text")
+            rv += 1
+        logger.info("Updated storage of {} texts".format(rv))
+        return rv
+
+    @staticmethod
+    def count_words(text):
+        """Return the number of words in `text`"""
+        return len(text.split(" ")) if text is not None else 0
+
+
+@event.listens_for(TextPercept.text, 'set')
+def update_word_count(target, value, oldvalue, initiator):
+    """Store word count whenever the text of a TextPercept is set"""
+    target.word_count = TextPercept.count_words(value)
+
+
+class PerceptResolver(object):
+    """Get or create many Percepts using one query per table
+
+    Collect tags, links, pictures and texts with the add methods, then call
+    `resolve` once and retrieve instances with `get`. Equal keys added
+    repeatedly resolve to the same instance.
+
+    Example:
+        resolver = PerceptResolver()
+        resolver.add(attachments)
+        resolver.resolve()
+        resolver.get("link", "http://example.com")
+    """
+
+    def __init__(self):
+        self.tags = set()
+        self.links = set()
+        self.pictures = set()
+        self.texts = dict()
+        self.resolved = dict()
+
+    def add(self, attachments):
+        """Add attachments as returned by helpers.scan_attachments"""
+        self.tags.update(attachments.tags)
+        self.links.update(attachments.links)
+        self.pictures.update(attachments.pictures)
+
+    def add_text(self, text, source=None):
+        """Add a text to be stored as a TextPercept"""
+        self.texts.setdefault(text, source)
+
+    def get(self, kind, key):
+        """Return the resolved Percept of `kind` for `key`
+
+        Args:
+            kind (String): One of 'tag', 'link', 'linkedpicture', 'text'
+            key (String): Tag name, URL or text that has been added
+
+        Raises:
+            KeyError: If `key` was not added before calling `resolve`
+        """
+        return self.resolved[(kind, key)]
+
+    def resolve(self, session=None):
+        """Load all existing Percepts and create the missing ones
+
+        Args:
+            session: SA session to use
+        """
+        if session is None:
+            session = db.session
+
+        hashes = dict()
+        for url in self.links:
+            hashes[LinkPercept.hash_url(url)] = ("link", url)
+        for url in self.pictures:
+            hashes[LinkedPicturePercept.hash_url(url)] = ("linkedpicture", url)
+        for text in self.texts:
+            hashes[TextPercept.hash_text(text)] = ("text", text)
+
+        if len(hashes) > 0:
+            percept_cls = with_polymorphic(Percept,
+                [LinkPercept, LinkedPicturePercept, TextPercept])
+            for percept in session.query(percept_cls) \
+                    .filter(percept_cls.id.in_(hashes.keys())):
+                self.resolved[hashes.pop(percept.id)] = percept
+
+        for h, (kind, key) in hashes.iteritems():
+            if kind == "link":
+                percept = LinkPercept(id=h, url=key)
+            elif kind == "linkedpicture":
+                logger.debug("Creating new linked picture for hash {}".format(h))
+                percept = LinkedPicturePercept(id=h, url=key)
+            else:
+                logger.info("Storing new text")
+                percept = TextPercept(id=h, text=key, source=self.texts[key])
+            self.resolved[(kind, key)] = percept
+
+        self.resolve_tags(session)
+
+    def resolve_tags(self, session):
+        """Create TagPercepts for all tag names, sharing one Tag per name
+
+        A name refers to an existing Tag if it is the Tag's name or the title
+        of one of its TagPercepts, see Tag.get_or_create.
+        """
+        if len(self.tags) == 0:
+            return
+
+        tags = dict()
+        rows = session.query(Tag, TagPercept.title) \
+            .outerjoin(TagPercept, TagPercept.tag_id == Tag.id) \
+            .filter(or_(Tag.name.in_(self.tags), TagPercept.title.in_(self.tags))) \
+            .all()
+
+        # Names take precedence over synonym titles
+        for tag, title in rows:
+            if title in self.tags:
+                tags.setdefault(title, tag)
+        for tag, title in rows:
+            if tag.name in self.tags:
+                tags[tag.name] = tag
+
+        for name in self.tags:
+            if name not in tags:
+                tags[name] = Tag(id=uuid4().hex, name=name)
+            self.resolved[("tag", name)] = TagPercept(title=name, tag=tags[name])
+
 
 class Upvote(Thought):
-    """A Upvote is a vote that signals interest in its parent Thought"""
+    """A Upvote is a vote that signals interest in its parent Thought
+
+    Deprecated, upvotes are now stored as Vote objects."""
 
     __mapper_args__ = {
         'polymorphic_identity': 'upvote'
@@ -1,12 +1,31 @@
 import logging
 import re
+import threading
+import time
 
+from bisect import bisect_left, insort
+from collections import defaultdict, namedtuple
 from datetime import datetime
 from goose import Goose
-from sqlalchemy import inspect
-
-from nucleus.nucleus import ExecutionTimer
-from nucleus.nucleus.connections import cache
+from hashlib import sha256
+from heapq import heappush, heapreplace
+from sqlalchemy import inspect, func
+from sqlalchemy.orm import lazyload
+
+from nucleus.nucleus import ExecutionTimer, ATTENTION_HALF_LIFE, \
+    LINK_PROBE_TIMEOUT, LINK_PROBE_DEADLINE, LINK_PROBE_WORKERS, \
+    LINK_PROBE_HOST_LIMIT, URL_META_CACHE_DURATION, \
+    URL_META_NEGATIVE_CACHE_DURATION, USERNAME_INDEX_MAX_AGE, \
+    IFRAME_URL_CACHE_DURATION, IFRAME_URL_NEGATIVE_CACHE_DURATION, \
+    IFRAME_URL_DEADLINE
+from nucleus.nucleus.caching import memoize_single_flight, cache_metrics, \
+    Dependency
+from nucleus.nucleus.connections import cache, db
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 # For calculating scores
@@ -16,68 +35,794 @@ epoch_seconds = lambda dt: (dt - epoch).total_seconds() - 1356048000
 logger = logging.getLogger('nucleus')
 
 
-def find_links(text):
+def hot_score(upvotes, created):
+    """Return a ranking score for a post that does not change over time
+
+    Newer posts receive a linearly growing time bonus, so an older post needs
+    exponentially more votes to rank above a newer one. This allows storing
+    the score in an indexed column instead of sorting by a decaying value.
+
+    Args:
+        upvotes (int): Number of upvotes the post received
+        created (datetime): Creation time of the post
+
+    Returns:
+        float: Score that can be compared to scores of other posts
+    """
+    from math import log10
+    upvotes = upvotes or 0
+    order = log10(max(abs(upvotes), 1))
+    sign = 1 if upvotes > 0 else -1 if upvotes < 0 else 0
+    return round(sign * order + epoch_seconds(created) / 45000, 7)
+
+
+def hot_decay(upvotes, created, now=None):
+    """Return a ranking score for a post that decays with the post's age
+
+    Args:
+        upvotes (int): Number of upvotes the post received
+        created (datetime): Creation time of the post
+        now (datetime): Reference time, defaults to current time
+
+    Returns:
+        float: Score as used by Thought.hot
+    """
+    from math import pow
+    if now is None:
+        now = datetime.utcnow()
+    t = (now - created).total_seconds() / 3600 + 2
+    return upvotes / pow(t, 1.5)
+
+
+def attention_decay(seconds):
+    """Return the factor by which attention decays over the given timespan
+
+    Attention decays exponentially, so that an aggregate of many decaying
+    values can be brought up to date by multiplying it with this factor.
+
+    Args:
+        seconds (float): Timespan over which attention decays
+
+    Returns:
+        float: Factor in (0, 1]
+    """
+    return pow(0.5, max(seconds, 0) / float(ATTENTION_HALF_LIFE))
+
+
+def sum_attention(keys, created, upvotes, now=None):
+    """Sum decayed upvotes grouped by key
+
+    Uses NumPy for the calculation if it is installed.
+
+    Args:
+        keys (list): Grouping key for each row
+        created (list): Creation datetime for each row
+        upvotes (list): Upvote count for each row
+        now (datetime): Reference time, defaults to current time
+
+    Returns:
+        dict: Attention aggregate for each key as used by
+            Identity._attention
+    """
+    if now is None:
+        now = datetime.utcnow()
+
+    if len(keys) == 0:
+        return dict()
+
+    if np is not None:
+        ages = (np.datetime64(now, 'us') - np.array(created, dtype='datetime64[us]')) \
+            / np.timedelta64(1, 's')
+        weights = np.array(upvotes, dtype=np.float64) * \
+            np.power(0.5, np.maximum(ages, 0) / float(ATTENTION_HALF_LIFE))
+        unique_keys, groups = np.unique(np.array(keys, dtype=object),
+            return_inverse=True)
+        sums = np.bincount(groups, weights=weights)
+        rv = dict(zip(unique_keys.tolist(), sums.tolist()))
+    else:
+        rv = defaultdict(float)
+        for key, c, u in zip(keys, created, upvotes):
+            rv[key] += u * attention_decay((now - c).total_seconds())
+    return rv
+
+
+class CounterBuffer(object):
+    """Collects changes to counters in the cache so they can be written to
+    the database in bulk
+
+    Changes are read with `collect` and only removed from the buffer by
+    `acknowledge`, which is called once they have been stored. A change
+    is collected by the first `collect` after the one that follows its
+    `add`. This leaves concurrent `add` calls time to complete.
+
+    Relies on the cache backend's `add`, `inc` and `dec` being atomic, as
+    they are for Redis and Memcached.
+
+    Args:
+        name (String): Namespace for the buffer's cache keys
+    """
+
+    # Counters are stored with an offset, because some backends can neither
+    # store negative numbers nor increment missing keys
+    offset = 2 ** 32
+
+    def __init__(self, name):
+        self.name = name
+
+    def _key(self, *parts):
+        return "/".join([self.name] + [str(p) for p in parts])
+
+    def _get(self, key):
+        value = cache.cache.get(key)
+        return int(value) - self.offset if value is not None else 0
+
+    def _change(self, key, delta):
+        backend = cache.cache
+        backend.add(key, self.offset, timeout=0)
+        if delta >= 0:
+            return backend.inc(key, delta)
+        else:
+            return backend.dec(key, -delta)
+
+    def add(self, counter_id, delta):
+        """Buffer a change to the counter with the given ID
+
+        Args:
+            counter_id (String): ID of the counted object
+            delta (int): Change of the counter
+        """
+        seq = self._change(self._key("seq"), 1) - self.offset
+        cache.cache.set(self._key("id", seq), counter_id, timeout=0)
+        self._change(self._key("counter", counter_id), delta)
+
+    def collect(self):
+        """Return buffered changes without removing them from the buffer
+
+        Returns:
+            tuple
+                0: dict with the summed up change for each counter ID
+                1: Token to pass to `acknowledge`
+        """
+        backend = cache.cache
+        start = self._get(self._key("flushed"))
+        end = self._get(self._key("observed"))
+        latest = self._get(self._key("seq"))
+
+        rv = dict()
+        if end > start:
+            id_keys = [self._key("id", seq) for seq in range(start + 1, end + 1)]
+            for counter_id in set(backend.get_many(*id_keys)) - set([None]):
+                delta = self._get(self._key("counter", counter_id))
+                if delta != 0:
+                    rv[counter_id] = delta
+        return (rv, (start, end, latest))
+
+    def acknowledge(self, changes, token):
+        """Remove changes returned by `collect` from the buffer
+
+        Must be called after the changes have been stored, also if there
+        were none.
+
+        Args:
+            changes (dict): Changes as returned by `collect`
+            token: Token as returned by `collect`
+        """
+        backend = cache.cache
+        start, end, latest = token
+        for counter_id, delta in changes.iteritems():
+            self._change(self._key("counter", counter_id), -delta)
+
+        if end > start:
+            backend.delete_many(*[self._key("id", seq)
+                for seq in range(start + 1, end + 1)])
+        backend.set(self._key("flushed"), end + self.offset, timeout=0)
+        backend.set(self._key("observed"), latest + self.offset, timeout=0)
+
+    def pending(self, counter_id):
+        """Return the buffered change for a counter ID"""
+        return self._get(self._key("counter", counter_id))
+
+
+upvote_buffer = CounterBuffer("upvote-buffer")
+
+
+def top_k(candidates, key, count, bound=None):
+    """Return the `count` items with the highest `key` from an iterable
+
+    Only `count` items are held in memory at any time. Ties are resolved in
+    favor of items that come first in `candidates`.
+
+    Args:
+        candidates (iterable): Items to select from
+        key (function): Returns the score of an item
+        count (int): Maximum number of items to return
+        bound (function): Optional. Returns an upper limit for the score of
+            the given item and all items following it. Iteration stops as
+            soon as this limit can't beat the lowest score kept so far.
+
+    Returns:
+        list: Up to `count` items, highest score first
+    """
+    heap = []
+    for i, item in enumerate(candidates):
+        if bound is not None and len(heap) == count \
+                and bound(item) <= heap[0][0]:
+            break
+
+        entry = (key(item), -i, item)
+        if len(heap) < count:
+            heappush(heap, entry)
+        elif entry[0] > heap[0][0]:
+            heapreplace(heap, entry)
+
+    return [item for score, i, item in sorted(heap, reverse=True)]
+
+
+def top_hot(query, count=10):
+    """Return the `count` hottest Thoughts from a query as measured by
+    Thought.hot
+
+    Thoughts are streamed from newest to oldest. As the score of a Thought
+    can't exceed the score it would have with the largest upvote count
+    among all candidates, streaming stops once that limit falls below the
+    lowest score kept.
+
+    Args:
+        query (Query): Selection of Thoughts to rank
+        count (int): Maximum number of Thoughts to return
+
+    Returns:
+        list: Up to `count` Thought objects, hottest first
+    """
+    from nucleus.nucleus.content import Thought
+    now = datetime.utcnow()
+
+    max_upvotes = query.with_entities(func.max(Thought._upvotes)).scalar() or 0
+    candidates = query \
+        .options(lazyload('*')) \
+        .order_by(Thought.created.desc()) \
+        .yield_per(100)
+
+    return top_k(candidates,
+        key=lambda t: hot_decay(t._upvotes or 0, t.created, now),
+        count=count,
+        bound=lambda t: hot_decay(max_upvotes, t.created, now))
+
+
+_http = dict()
+_http_lock = threading.Lock()
+
+# Page contents as extracted by Goose
+Page = namedtuple("Page", ["title", "cleaned_text"])
+
+
+class LinkProbe(object):
+    """Result of probing a URL with a HEAD request
+
+    Provides the parts of a requests Response object used by
+    process_attachments, so that results can be cached.
+
+    Attributes:
+        url: URL that was probed
+        status_code: HTTP status code or None if there was no response
+        headers: Dict with key 'content-type' if a content type was sent
+        error: Description of the error that prevented a response or None
+    """
+
+    def __init__(self, url, status_code=None, content_type=None, error=None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = dict()
+        if content_type is not None:
+            self.headers["content-type"] = content_type
+        self.error = error
+
+    def __nonzero__(self):
+        return self.error is None and self.status_code < 400
+
+    def __repr__(self):
+        return "<LinkProbe {} ({})>".format(self.url,
+            self.error or self.status_code)
+
+
+def normalize_url(url):
+    """Return a canonical form of `url` for use as a cache key
+
+    Lowercases scheme and host, removes default ports and fragments.
+
+    Args:
+        url (String): URL including scheme
+
+    Returns:
+        String: Normalized URL
+    """
+    from urlparse import urlparse, urlunparse
+
+    parsed = urlparse(url)
+    scheme = parsed.scheme.lower()
+    netloc = parsed.netloc.lower()
+    if (scheme, netloc[-3:]) == ("http", ":80") \
+            or (scheme, netloc[-4:]) == ("https", ":443"):
+        netloc = netloc.rsplit(":", 1)[0]
+    return urlunparse((scheme, netloc, parsed.path or "/", parsed.params,
+        parsed.query, ""))
+
+
+def url_meta_key(url):
+    return "url-meta/{}".format(sha256(normalize_url(url)).hexdigest())
+
+
+def get_url_meta(urls):
+    """Return cached metadata for the given URLs
+
+    Args:
+        urls (iterable): URLs including scheme
+
+    Returns:
+        dict: Metadata dict for each URL found in the cache with keys
+            status, content_type, error of the link probe and optionally
+            title, cleaned_text, extract_error of the page extraction
+    """
+    urls = list(urls)
+    if len(urls) == 0:
+        return dict()
+
+    metas = cache.get_many(*[url_meta_key(url) for url in urls])
+    return dict((url, meta) for url, meta in zip(urls, metas) if meta is not None)
+
+
+def set_url_meta(url, **kwargs):
+    """Store metadata for a URL in the cache, keeping existing fields
+
+    Metadata containing a probe or extraction error is kept for a shorter
+    duration.
+
+    Args:
+        url (String): URL including scheme
+        kwargs: Metadata fields to set
+    """
+    meta = get_url_meta([url]).get(url, dict())
+    meta.update(kwargs)
+    timeout = URL_META_NEGATIVE_CACHE_DURATION \
+        if meta.get("error") or meta.get("extract_error") \
+        else URL_META_CACHE_DURATION
+    cache.set(url_meta_key(url), meta, timeout=timeout)
+
+
+def extract_page(url):
+    """Return title and text of the page at `url`, using cached results
+
+    Args:
+        url (String): URL including scheme
+
+    Returns:
+        Page: Extracted title and cleaned text, which are empty if the page
+            could not be extracted
+    """
+    meta = get_url_meta([url]).get(url)
+    if meta is not None and "title" in meta:
+        return Page(meta["title"], meta["cleaned_text"])
+
+    try:
+        page = Goose().extract(url=url)
+    except Exception, e:
+        logger.warning("Error extracting {}: {}".format(url, e))
+        set_url_meta(url, title="", cleaned_text="", extract_error=str(e))
+        return Page("", "")
+
+    set_url_meta(url, title=page.title, cleaned_text=page.cleaned_text)
+    return Page(page.title, page.cleaned_text)
+
+
+def http_session():
+    """Return a requests session and thread pool shared by all link probes
+
+    Returns:
+        tuple: requests.Session with keep-alive connection pool and
+            multiprocessing.pool.ThreadPool
+    """
+    with _http_lock:
+        if "session" not in _http:
+            import requests
+            from multiprocessing.pool import ThreadPool
+
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=LINK_PROBE_WORKERS,
+                pool_maxsize=LINK_PROBE_WORKERS)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+
+            _http["session"] = session
+            _http["pool"] = ThreadPool(LINK_PROBE_WORKERS)
+            _http["hosts"] = defaultdict(
+                lambda: threading.BoundedSemaphore(LINK_PROBE_HOST_LIMIT))
+        return _http["session"], _http["pool"]
+
+
+def probe_url(url, deadline):
+    """Send a HEAD request to `url` without exceeding LINK_PROBE_HOST_LIMIT
+    concurrent requests per host
+
+    Args:
+        url (String): URL including scheme
+        deadline (float): Time (as in time.time()) after which the request
+            is not sent anymore
+
+    Returns:
+        LinkProbe: Result of the request
+    """
+    import requests
+    from urlparse import urlparse
+
+    session, pool = http_session()
+    with _http_lock:
+        host_limit = _http["hosts"][urlparse(url).netloc]
+
+    with host_limit:
+        timeout = min(LINK_PROBE_TIMEOUT, deadline - time.time())
+        if timeout <= 0:
+            return LinkProbe(url, error="Deadline exceeded before probing")
+
+        logger.debug("Testing potential link '{}' for availability".format(url))
+        try:
+            res = session.head(url, timeout=timeout)
+        except (requests.exceptions.RequestException, ValueError), e:
+            return LinkProbe(url, error=str(e))
+
+        return LinkProbe(res.url, status_code=res.status_code,
+            content_type=res.headers.get("content-type"))
+
+
+def probe_urls(urls):
+    """Probe all given URLs concurrently, see probe_url
+
+    Results are cached, including failed probes.
+
+    Args:
+        urls (iterable): URLs including scheme
+
+    Returns:
+        dict: LinkProbe for each URL. URLs that were not probed before
+            LINK_PROBE_DEADLINE are missing.
+    """
+    from multiprocessing import TimeoutError
+
+    urls = set(urls)
+    rv = dict()
+    for url, meta in get_url_meta(urls).iteritems():
+        if "status" in meta:
+            rv[url] = LinkProbe(meta.get("url", url), status_code=meta["status"],
+                content_type=meta["content_type"], error=meta["error"])
+
+    session, pool = http_session()
+    deadline = time.time() + LINK_PROBE_DEADLINE
+    pending = dict((url, pool.apply_async(probe_url, (url, deadline)))
+        for url in urls if url not in rv)
+
+    for url, result in pending.iteritems():
+        try:
+            probe = result.get(timeout=max(deadline - time.time(), 0))
+        except TimeoutError:
+            logger.info("Probing {} exceeded deadline".format(url))
+        else:
+            rv[url] = probe
+            set_url_meta(url, url=probe.url, status=probe.status_code,
+                content_type=probe.headers.get("content-type"),
+                error=probe.error or (None if probe else "HTTP {}".format(
+                    probe.status_code)))
+    return rv
+
+
+YOUTUBE_EXPR = re.compile(
+    r"^.*((youtu.be\/)|(v\/)|(\/u\/\w\/)|(embed\/)|(watch\?))\??v?=?([^#\&\?]*).*")
+
+SOUNDCLOUD_PLAYER_URL = "https://w.soundcloud.com/player/?url=https%3A//api.soundcloud.com/tracks/{track_id}&amp;auto_play=false&amp;hide_related=false&amp;show_comments=true&amp;show_user=true&amp;show_reposts=false&amp;visual=true"
+
+
+def iframe_url_key(url):
+    return "iframe-url/{}".format(sha256(normalize_url(url)).hexdigest())
+
+
+def resolve_iframe_url(url, deadline):
+    """Return a URL to embed content linked by `url` within an iframe
+
+    Soundcloud tracks are resolved using the shared HTTP session.
+
+    Args:
+        url (String): URL including scheme
+        deadline (float): Time (as in time.time()) after which no request
+            is sent anymore
+
+    Returns:
+        tuple
+            0: Embeddable URL or None if the domain doesn't provide embeds
+            1: Description of the error that prevented resolving or None
+    """
+    import os
+    import requests
+    from urlparse import urlparse
+
+    netloc = urlparse(url).netloc
+    if netloc == "www.youtube.com":
+        # http://stackoverflow.com/a/8260383
+        matches = YOUTUBE_EXPR.search(url)
+        if matches and matches.groups()[-1] and len(matches.groups()[-1]) == 11:
+            return ("https://www.youtube.com/embed/{id}".format(
+                id=matches.groups()[-1]), None)
+
+    elif netloc == "soundcloud.com":
+        client_id = os.environ.get("SOUNDCLOUD_CLIENT_ID")
+        if not client_id:
+            logger.warning("Please set env var SOUNDCLOUD_CLIENT_ID to enable embeds")
+            return (None, "Missing Soundcloud client id")
+
+        timeout = min(LINK_PROBE_TIMEOUT, deadline - time.time())
+        if timeout <= 0:
+            return (None, "Deadline exceeded before resolving")
+
+        session, pool = http_session()
+        try:
+            res = session.get("https://api.soundcloud.com/resolve",
+                params={"url": url, "client_id": client_id}, timeout=timeout)
+            res.raise_for_status()
+            track = res.json()
+        except (requests.exceptions.RequestException, ValueError), e:
+            logger.warning("Error connecting to Soundcloud: {}".format(e))
+            return (None, str(e))
+
+        if track and "id" in track:
+            return (SOUNDCLOUD_PLAYER_URL.format(track_id=track["id"]), None)
+
+    return (None, None)
+
+
+def iframe_urls(urls):
+    """Return embeddable URLs for all given URLs, see resolve_iframe_url
+
+    URLs that are not cached are resolved concurrently. Results are cached,
+    failures for a shorter duration.
+
+    Args:
+        urls (iterable): URLs including scheme
+
+    Returns:
+        dict: Embeddable URL or None for each URL
+    """
+    from multiprocessing import TimeoutError
+
+    urls = list(set(urls))
+    if len(urls) == 0:
+        return dict()
+
+    rv = dict()
+    cached = cache.get_many(*[iframe_url_key(url) for url in urls])
+    for url, entry in zip(urls, cached):
+        if entry is not None:
+            rv[url] = entry["url"]
+
+    cache_metrics.count("iframe_url", "hits", len(rv))
+    cache_metrics.count("iframe_url", "misses", len(urls) - len(rv))
+    if len(rv) == len(urls):
+        return rv
+
+    session, pool = http_session()
+    start = time.time()
+    deadline = start + IFRAME_URL_DEADLINE
+    pending = dict((url, pool.apply_async(resolve_iframe_url, (url, deadline)))
+        for url in urls if url not in rv)
+
+    for url, result in pending.iteritems():
+        try:
+            embed_url, error = result.get(timeout=max(deadline - time.time(), 0))
+        except TimeoutError:
+            logger.info("Resolving embed for {} exceeded deadline".format(url))
+            rv[url] = None
+        else:
+            rv[url] = embed_url
+            cache.set(iframe_url_key(url), {"url": embed_url},
+                timeout=IFRAME_URL_NEGATIVE_CACHE_DURATION if error
+                    else IFRAME_URL_CACHE_DURATION)
+    cache_metrics.computed("iframe_url", time.time() - start)
+    return rv
+
+
+# Tags, mentions and everything that looks remotely like a URL
+TOKEN_EXPR = re.compile(
+    r"#(?P<tag>\S{1,32})"
+    r"|@(?P<mention>\S{3,80})"
+    r"|(?P<link>(?:https?://)?\S+\.\w{2,3}\S*)")
+
+# A tag, mention or link found in a text. Value doesn't include the leading
+# '#' or '@', start and end are offsets including them.
+Token = namedtuple("Token", ["kind", "value", "start", "end"])
+
+
+def tokenize(text):
+    """Find all tags, mentions and links in a text in a single pass
+
+    Args:
+        text (String): The input to parse
+
+    Returns:
+        list: Token objects in order of their occurrence
+    """
+    return [Token(m.lastgroup, m.group(m.lastgroup), m.start(), m.end())
+        for m in TOKEN_EXPR.finditer(text)]
+
+
+def strip_trailing(text, tokens, keep=None):
+    """Remove tokens from the end of a text as long as they are followed by
+    nothing but whitespace
+
+    Args:
+        text (String): The text the tokens were found in
+        tokens (list): Tokens that may be removed, in order of occurrence
+        keep (function): Optional. Returns True for tokens that must not be
+            removed, which also prevents removal of all tokens before them
+
+    Returns:
+        String: Text with trailing tokens removed
+    """
+    for token in reversed(tokens):
+        if token.end != len(text.rstrip()):
+            if token.end > len(text):
+                continue
+            break
+        if keep is not None and keep(token):
+            break
+        text = text[:token.start]
+    return text
+
+
+def find_links(text, tokens=None):
     """Given a text, find all alive links inside
 
     Args:
         text(String): The input to parse
+        tokens (list): Result of tokenize(text) if already available
 
     Returns:
         tuple:
-            list: List of response objects for found URLs
+            list: List of LinkProbe objects for found URLs
             str: Text with links removed if they occur at the end
     """
-    import requests
+    if tokens is None:
+        tokens = tokenize(text)
 
-    # Everything that looks remotely like a URL
-    expr = "((?:https?://)?\S+\.\w{2,3}\S*)"
+    links = [t for t in tokens if t.kind == "link" and t.end <= len(text)]
     rv = list()
-    rejects = set()
-
-    candidates = re.findall(expr, text)
-
-    if candidates:
-        for i, c in enumerate(candidates[::-1]):
-            if c[:4] != "http":
-                c_schemed = "".join(["http://", c])
-            else:
-                c_schemed = c
-
-            if c_schemed not in rejects:
-                logger.debug("Testing potential link '{}' for availability".format(c_schemed))
-                try:
-                    res = requests.head(c_schemed, timeout=3.0)
-                except (requests.exceptions.RequestException, ValueError), e:
-                    logger.info("Not a suitable link ({})".format(e))
-                    rejects.add(c_schemed)
-                else:
-                    if res and res.status_code < 400:
-                        rv.append(res)
-                        # Only remove link if it occurs at the end of text
-                        if (text.index(c) + len(c)) == len(text.rstrip()):
-                            text = text.replace(c, "")
-                    else:
-                        res = "No response object" if res is None else res
-                        logger.info("Not a suitable link ({})\n{}".format(res, c_schemed))
+    rejected = set()
+    found = set()
+
+    if links:
+        schemed = dict((t, t.value if t.value[:4] == "http"
+            else "".join(["http://", t.value])) for t in links)
+        responses = probe_urls(schemed.values())
+
+        for t in reversed(links):
+            res = responses.get(schemed[t])
+            if res is None or not res:
+                logger.info("Not a suitable link ({})\n{}".format(
+                    "Timed out" if res is None
+                    else res.error or res.status_code, schemed[t]))
+                rejected.add(t)
+            elif schemed[t] not in found:
+                found.add(schemed[t])
+                rv.append(res)
+
+        # Only remove links if they occur at the end of text
+        text = strip_trailing(text, links, keep=lambda t: t in rejected)
     return (rv, text)
 
 
-def find_mentions(text):
+class UsernameIndex(object):
+    """In-process mapping of usernames to Identity IDs for mention
+    autocompletion
+
+    Loaded from the database on first use and after USERNAME_INDEX_MAX_AGE
+    seconds. Identities created or renamed in this process are updated
+    immediately.
+    """
+
+    def __init__(self):
+        self.ids = dict()
+        self.names = list()
+        self.loaded = None
+        self.lock = threading.Lock()
+
+    def _refresh(self):
+        if self.loaded is not None \
+                and time.time() - self.loaded < USERNAME_INDEX_MAX_AGE:
+            return
+
+        import identity
+        rows = identity.Identity.query \
+            .with_entities(identity.Identity.username, identity.Identity.id) \
+            .filter(identity.Identity.username != None) \
+            .all()
+
+        with self.lock:
+            self.ids = dict(rows)
+            self.names = sorted(self.ids.keys())
+            self.loaded = time.time()
+        logger.debug("Loaded username index with {} entries".format(len(rows)))
+
+    def add(self, username, ident_id):
+        """Add a new Identity to the index"""
+        if username is None or self.loaded is None:
+            return
+
+        with self.lock:
+            if username not in self.ids:
+                insort(self.names, username)
+            self.ids[username] = ident_id
+
+    def remove(self, username, ident_id):
+        """Remove a username if it belongs to the given Identity"""
+        with self.lock:
+            if self.ids.get(username) == ident_id:
+                del self.ids[username]
+                self.names.remove(username)
+
+    def complete(self, prefix, limit=10):
+        """Return usernames starting with `prefix`
+
+        Args:
+            prefix (String): Start of the username
+            limit (int): Maximum number of results
+
+        Returns:
+            list: Tuples of (username, identity id) in alphabetical order
+        """
+        self._refresh()
+        rv = list()
+        with self.lock:
+            for name in self.names[bisect_left(self.names, prefix):]:
+                if not name.startswith(prefix) or len(rv) >= limit:
+                    break
+                rv.append((name, self.ids[name]))
+        return rv
+
+
+username_index = UsernameIndex()
+
+
+def find_mentions(text, tokens=None, session=None):
     """Given some text, find mentioned Identities formatted as "@<username>
 
+    All mentions are resolved with a single query on the indexed username
+    column. The in-process username index is not used here, as it may be
+    out of date with respect to other processes.
+
     Args:
         text: input text
+        tokens (list): Result of tokenize(text) if already available
+        session: SA session to load Identities with. Defaults to db.session.
 
     Returns:
         iterable: pairs of (mention_text, Identity_object)
     """
     import identity
-    expr = "@([\S]{3,80})"
     rv = []
 
-    res = re.findall(expr, text)
+    if session is None:
+        session = db.session
+
+    if tokens is None:
+        tokens = tokenize(text)
+
+    res = [t.value for t in tokens if t.kind == "mention"]
+    if len(res) == 0:
+        return rv
+
+    idents = session.query(identity.Identity) \
+        .filter(identity.Identity.username.in_(set(res))) \
+        .all()
+    idents = dict((ident.username, ident) for ident in idents)
+
     for mention_text in res:
-        ident = identity.Identity.query.filter_by(username=mention_text).first()
+        ident = idents.get(mention_text)
         if ident is not None:
             rv.append((mention_text, ident))
         else:
@@ -87,31 +832,60 @@ def find_mentions(text):
     return rv
 
 
-def find_tags(text):
+def find_tags(text, tokens=None):
     """Given some text, find tags of the form "#<tag> with 1-32 chars and no
         whitespace. Remove tags from text if they occur at the end and their
         removal doesn't make text empty.
 
     Args:
         text: input text
+        tokens (list): Result of tokenize(text) if already available
 
     Returns:
         tuple:
             iterable: list of found tags
             text: input text
     """
+    if tokens is None:
+        tokens = tokenize(text)
 
-    expr = "#([\S]{1,32})"
-    text_new = text
-
-    rv = re.findall(expr, text)[::-1]
-    for tag in rv:
-        if(text_new.index(tag) + len(tag)) == len(text_new.rstrip()):
-            text_new = text_new.replace("#{}".format(tag), "")
+    tags = [t for t in tokens if t.kind == "tag"]
+    rv = [t.value for t in reversed(tags)]
+    text_new = strip_trailing(text, tags)
 
     return (rv, text_new) if len(text_new) > 0 else (rv, text)
 
 
+# Attachment hints found in a text, see scan_attachments
+Attachments = namedtuple("Attachments", ["tags", "mentions", "links", "pictures"])
+
+
+def scan_attachments(text, session=None):
+    """Given some text a user entered, find all attachments hinted at
+
+    Args:
+        text (String): Message entered by user
+        session: SA session to load mentioned Identities with
+
+    Return:
+        Tuple
+            0: Message with some attachment hints removed (URLs)
+            1: Attachments with lists of tag names, (mention text, Identity)
+                pairs, link URLs and picture URLs
+    """
+    tokens = tokenize(text)
+
+    tags, text = find_tags(text, tokens=tokens)
+    mentions = find_mentions(text, tokens=tokens, session=session)
+    links, text = find_links(text, tokens=tokens)
+
+    pictures = [link.url for link in links if "content-type" in link.headers
+        and link.headers["content-type"][:5] == "image"]
+    links = [link.url for link in links if link.url not in pictures]
+
+    return (text, Attachments(tags, mentions, links, pictures))
+
+
 def process_attachments(text):
     """Given some text a user entered, extract all attachments
     hinted at and return user message plus a list of Percept objects.
@@ -130,58 +904,85 @@ def process_attachments(text):
     """
     import content
 
-    g = Goose()
+    text, attachments = scan_attachments(text)
+    resolver = content.PerceptResolver()
+    resolver.add(attachments)
+    resolver.resolve()
+    return build_attachments(text, attachments, resolver)
+
+
+def build_attachments(text, attachments, resolver):
+    """Return Percept objects for attachments found by scan_attachments
+
+    If the message is empty it is replaced by a picture's filename or a
+    linked page's title.
+
+    Args:
+        text (String): Message as returned by scan_attachments
+        attachments (Attachments): As returned by scan_attachments
+        resolver (PerceptResolver): Resolver to which `attachments` have
+            been added and that has been resolved
+
+    Return:
+        Tuple
+            0: Message
+            1: Set of Percept instances
+    """
+    import content
+
     percepts = set()
 
-    tags, text = find_tags(text)
-    for tag in tags:
-        tagpercept = content.TagPercept(title=tag)
-        percepts.add(tagpercept)
+    for tag in attachments.tags:
+        percepts.add(resolver.get("tag", tag))
 
-    mentions = find_mentions(text)
-    for mention_text, ident in mentions:
+    for mention_text, ident in attachments.mentions:
         mention = content.Mention(identity=ident, text=mention_text)
         percepts.add(mention)
 
-    links, text = find_links(text)
-    for link in links:
-        if "content-type" in link.headers and link.headers["content-type"][:5] == "image":
-            linkpercept = content.LinkedPicturePercept.get_or_create(link.url)
+    for url in attachments.pictures:
+        percepts.add(resolver.get("linkedpicture", url))
 
-            # Use picture filename as user message if empty
-            if len(text) == 0:
-                text = link.url[(link.url.rfind('/') + 1):]
-        else:
-            linkpercept = content.LinkPercept.get_or_create(link.url)
-            page = g.extract(url=link.url)
+        # Use picture filename as user message if empty
+        if len(text) == 0:
+            text = url[(url.rfind('/') + 1):]
+
+    for url in attachments.links:
+        linkpercept = resolver.get("link", url)
+
+        # Known links only need extraction for an empty user message
+        if inspect(linkpercept).transient is False and len(text) > 0:
+            percepts.add(linkpercept)
+            continue
+
+        page = extract_page(url)
 
-            # Add metadata if percept object is newly created
-            if inspect(linkpercept).transient is True:
-                linkpercept.title = page.title
+        # Add metadata if percept object is newly created
+        if inspect(linkpercept).transient is True:
+            linkpercept.title = page.title
 
-            # Extract article contents as new Percept
-            if len(page.cleaned_text) > 300:
-                # Temporarily disable automatic text attachment
+        # Extract article contents as new Percept
+        if len(page.cleaned_text) > 300:
+            # Temporarily disable automatic text attachment
 
-                # textpercept = TextPercept.get_or_create(page.cleaned_text)
-                # textpercept.source = link.url
+            # textpercept = TextPercept.get_or_create(page.cleaned_text)
+            # textpercept.source = url
 
-                # percepts.add(textpercept)
-                pass
+            # percepts.add(textpercept)
+            pass
 
-            if len(text) == 0:
-                text = page.title
+        if len(text) == 0:
+            text = page.title
         percepts.add(linkpercept)
 
     return (text, percepts)
 
 
-@cache.memoize(timeout=60 * 60 * 24)
+@memoize_single_flight(timeout=60 * 60 * 24, depends=[
+    Dependency("Thought", attrs=("state", ))])
 def recent_thoughts(session=None):
     """Return 10 most recent Thoughts
 
-    Cache is reset when calling Thought.create_from_input
-    or Thought.set_state
+    Cache is reset when Thoughts are created or change state
 
     Args:
         session: SA session to use
@@ -195,10 +996,9 @@ def recent_thoughts(session=None):
     timer = ExecutionTimer()
 
     if session is None:
-        from .connections import db
         session = db.session
 
-    res = session.query(Thought) \
+    res = Thought.query_profile("list", session=session) \
         .filter_by(state=0) \
         .filter_by(kind="thought") \
         .order_by(Thought.created.desc()) \
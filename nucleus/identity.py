@@ -16,12 +16,13 @@ from flask import url_for
 from flask.ext.login import current_user, UserMixin
 from hashlib import sha256
 from uuid import uuid4
-from sqlalchemy import or_, Column, Integer, String, Boolean, DateTime, Table, \
-    ForeignKey, Text, UniqueConstraint, func
+from sqlalchemy import or_, and_, Column, Integer, String, Boolean, DateTime, Table, \
+    ForeignKey, Text, UniqueConstraint, func, Float, event, inspect
 from sqlalchemy.orm import relationship
+from sqlalchemy.sql.expression import bindparam
 from sqlalchemy.orm.session import Session
 
-from . import logger, ATTENTION_CACHE_DURATION, ATTENTION_MULT, \
+from . import logger, ATTENTION_MULT, ATTENTION_REBASE_AGE, \
     ExecutionTimer, CONVERSATION_LIST_CACHE_DURATION, TOP_THOUGHT_CACHE_DURATION, \
     UnauthorizedError, PERSONA_MOVEMENTS_CACHE_DURATION, REPOST_MINDSET_CACHE_DURATION, \
     SUGGESTED_MOVEMENTS_CACHE_DURATION, MEMBER_COUNT_CACHE_DURATION, \
@@ -29,7 +30,9 @@ from . import logger, ATTENTION_CACHE_DURATION, ATTENTION_MULT, \
     movement_chat
 
 from .base import Model, BaseModel
-from .connections import cache
+from .caching import memoize_entity, memoize_single_flight, Dependency
+from .connections import cache, db
+from .helpers import attention_decay, sum_attention, username_index
 # from .content import Notification, Thought, Blog, Upvote
 # from .context import Dialogue, Mindset, Mindspace
 
@@ -175,6 +178,9 @@ class Identity(Model):
         sign_public: Public signing RSA key, JSON encoded KeyCzar export
         modified: Last time this Identity object was modified, defaults to now
         blog: Mindset containing this Identity's blog
+        _attention: Sum of upvotes on this Identity's Thoughts, each decayed
+            from the Thought's creation until `_attention_updated`
+        _attention_dirty: Set when `_attention` needs to be recalculated
 
     """
 
@@ -191,7 +197,11 @@ class Identity(Model):
     created = Column(DateTime())
     kind = Column(String(32))
     modified = Column(DateTime(), default=datetime.datetime.utcnow())
-    username = Column(String(80))
+    username = Column(String(80), index=True)
+
+    _attention = Column(Float(), default=0.0)
+    _attention_updated = Column(DateTime(), default=datetime.datetime.utcnow)
+    _attention_dirty = Column(Boolean(), default=False, index=True)
 
     # Relations
     blog_id = Column(String(32), ForeignKey('mindset.id'))
@@ -226,12 +236,180 @@ class Identity(Model):
             return (self.id == author_id)
         return False
 
+    def add_attention(self, upvotes, created):
+        """Account for upvotes received by one of this Identity's Thoughts
+
+        The upvotes are added to the stored aggregate with a single atomic
+        update, weighted for the aggregate's reference time
+        `_attention_updated`, which stays unchanged. Concurrent votes thus
+        can't overwrite each other. The Identity is marked for recalculation
+        instead if its aggregate is missing, its reference time is older than
+        ATTENTION_REBASE_AGE or was changed by a recalculation in the meantime.
+
+        Args:
+            upvotes (int): Change in upvote count, may be negative
+            created (datetime): Creation time of the upvoted Thought
+        """
+        session = Session.object_session(self)
+        t = Identity.__table__
+        updated = self._attention_updated
+
+        rows = 0
+        if self._attention is not None and updated is not None and \
+                (datetime.datetime.utcnow() - updated).total_seconds() \
+                < ATTENTION_REBASE_AGE:
+            # Thoughts created after the reference time weigh more than one
+            age = (updated - created).total_seconds()
+            weight = attention_decay(age) if age >= 0 \
+                else 1 / attention_decay(-age)
+
+            rows = session.execute(t.update()
+                .where(and_(t.c.id == self.id,
+                    t.c._attention_updated == updated))
+                .values(_attention=t.c._attention + upvotes * weight)).rowcount
+
+        if rows == 0:
+            session.execute(t.update()
+                .where(t.c.id == self.id)
+                .values(_attention_dirty=True))
+
+        session.expire(self, ['_attention', '_attention_dirty'])
+        Identity.expire_rows(session, [self.id])
+
+    def attention_thoughts(self):
+        """Return a query for Thoughts that contribute to this Identity's
+        attention value"""
+        ses = Session.object_session(self)
+        return ses.query(content.Thought) \
+            .filter_by(author=self) \
+            .filter(content.Thought.state >= 0)
+
+    def decayed_attention(self, now=None):
+        """Return the stored attention aggregate decayed until `now`
+
+        Args:
+            now (datetime): Reference time, defaults to current time
+
+        Returns:
+            float: Decayed attention aggregate
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+        return self._attention * attention_decay(
+            (now - self._attention_updated).total_seconds())
+
+    def get_attention(self):
+        """Return a numberic value indicating attention this Identity has received
+
+        Returns:
+            integer: Attention as a positive integer
+        """
+        if self._attention is None or self._attention_updated is None:
+            self.recompute_attention()
+        return int(max(self.decayed_attention(), 0) * ATTENTION_MULT)
+
+    attention = property(get_attention)
+
+    @classmethod
+    def recompute_attention_batch(cls, session):
+        """Recalculate the attention aggregate of all Identities at once
+
+        Loads upvote counts of all contributing Thoughts in a single query
+        and writes the results with one bulk update.
+
+        Args:
+            session: SA session to use
+
+        Returns:
+            int: Number of updated Identities
+        """
+        timer = ExecutionTimer()
+        now = datetime.datetime.utcnow()
+
+        kinds = dict(session.query(Identity.id, Identity.kind))
+        rows = session.query(
+                content.Thought.author_id,
+                context.Mindset.author_id,
+                context.Mindset.kind,
+                content.Thought.created,
+                content.Thought._upvotes) \
+            .outerjoin(context.Mindset,
+                context.Mindset.id == content.Thought.mindset_id) \
+            .filter(content.Thought.state >= 0) \
+            .filter(content.Thought.kind != "upvote") \
+            .filter(content.Thought._upvotes > 0) \
+            .all()
+
+        # Personas receive attention for Thoughts they authored, Movements for
+        # Thoughts in their blog and mindspace
+        keys = list()
+        created = list()
+        upvotes = list()
+        for author_id, mindset_author_id, mindset_kind, c, u in rows:
+            if kinds.get(author_id) == "persona":
+                keys.append(author_id)
+                created.append(c)
+                upvotes.append(u)
+            if kinds.get(mindset_author_id) == "movement" \
+                    and mindset_kind in ("blog", "mindspace"):
+                keys.append(mindset_author_id)
+                created.append(c)
+                upvotes.append(u)
+
+        sums = sum_attention(keys, created, upvotes, now=now)
+
+        t = Identity.__table__
+        stmt = t.update() \
+            .where(t.c.id == bindparam("b_id")) \
+            .values(_attention=bindparam("b_attention"),
+                _attention_updated=bindparam("b_updated"),
+                _attention_dirty=False)
+        session.execute(stmt, [dict(b_id=ident_id,
+            b_attention=sums.get(ident_id, 0.0), b_updated=now)
+            for ident_id in kinds])
+        Identity.expire_rows(session, kinds.keys())
+
+        timer.stop("Generated attention values for {} identities".format(
+            len(kinds)))
+        return len(kinds)
+
+    def recompute_attention(self):
+        """Recalculate the attention aggregate from all contributing Thoughts"""
+        timer = ExecutionTimer()
+        now = datetime.datetime.utcnow()
+        thoughts = self.attention_thoughts() \
+            .with_entities(content.Thought.created, content.Thought._upvotes)
+
+        self._attention = sum([upvotes * attention_decay(
+            (now - created).total_seconds())
+            for created, upvotes in thoughts if upvotes])
+        self._attention_updated = now
+        self._attention_dirty = False
+        timer.stop("Generated attention value for {}".format(self))
+
     def notification_list(self, limit=5):
         return self.notifications \
             .filter_by(unread=True) \
             .order_by(content.Notification.modified.desc()) \
             .limit(limit) \
             .all()
+
+
+@event.listens_for(Identity, 'after_insert', propagate=True)
+@event.listens_for(Identity, 'after_update', propagate=True)
+def update_username_index(mapper, connection, target):
+    """Keep the in-process username index current"""
+    for username in inspect(target).attrs.username.history.deleted:
+        username_index.remove(username, target.id)
+    username_index.add(target.username, target.id)
+
+
+@event.listens_for(Identity, 'after_delete', propagate=True)
+def remove_from_username_index(mapper, connection, target):
+    """Drop deleted Identities from the in-process username index"""
+    username_index.remove(target.username, target.id)
+
+
 #
 # Setup follower relationship on Persona objects
 #
@@ -289,28 +467,13 @@ class Persona(Identity):
             return (self.id == author_id)
         return False
 
-    @cache.memoize(timeout=ATTENTION_CACHE_DURATION)
-    def get_attention(self):
-        """Return a numberic value indicating attention this Persona has received
-
-        Returns:
-            integer: Attention as a positive integer
-        """
-        timer = ExecutionTimer()
-        ses = Session.object_session(self)
-        thoughts = ses.query(content.Thought) \
-            .filter_by(author=self)
-
-        rv = int(sum([t.hot() for t in thoughts]) * ATTENTION_MULT)
-        timer.stop("Generated attention value for {}".format(self))
-        return rv
-
-    attention = property(get_attention)
-
-    @cache.memoize(timeout=CONVERSATION_LIST_CACHE_DURATION)
-    def conversation_list(self):
+    @memoize_single_flight(timeout=CONVERSATION_LIST_CACHE_DURATION)
+    def conversation_list(self, session=None):
         """Return a list of conversations this persona had
 
+        Args:
+            session: SA session to use
+
         Returns:
             list: List of dicts with keys
                 persona_id: id of the other side of the conversation
@@ -318,17 +481,20 @@ class Persona(Identity):
                 modified: last thought in the conversation
         """
         timer = ExecutionTimer()
-        convs_query = context.Dialogue.query \
+        if session is None:
+            session = db.session
+
+        convs_query = session.query(context.Dialogue) \
             .filter(or_(
-                context.Dialogue.author == self,
-                context.Dialogue.other == self
+                context.Dialogue.author_id == self.id,
+                context.Dialogue.other_id == self.id
             )).all()
 
         convs = list()
         for c in convs_query:
             last_post = c.index.order_by(content.Thought.created.desc()).first()
             if last_post:
-                other = c.other if c.author == self else c.author
+                other = c.other if c.author_id == self.id else c.author
                 conv_dict = dict(
                     persona_id=other.id,
                     persona_username=other.username,
@@ -339,7 +505,11 @@ class Persona(Identity):
         timer.stop("Generated conversation list for {}".format(self))
         return convs
 
-    @cache.memoize(timeout=TOP_THOUGHT_CACHE_DURATION)
+    @memoize_entity("identity", timeout=TOP_THOUGHT_CACHE_DURATION, depends=[
+        Dependency("Identity", target=lambda ident: ident.id,
+            attrs=("blogs_followed", )),
+        Dependency("MovementMemberAssociation", target=lambda mma: mma.persona_id,
+            attrs=("active", ))])
     def frontpage_sources(self):
         """Return mindset IDs that provide posts for this Persona's frontpage
 
@@ -361,7 +531,9 @@ class Persona(Identity):
         """Return sha256 hash of this user's email address"""
         return sha256(self.email).hexdigest()
 
-    @cache.memoize(timeout=PERSONA_MOVEMENTS_CACHE_DURATION)
+    @memoize_entity("identity", timeout=PERSONA_MOVEMENTS_CACHE_DURATION, depends=[
+        Dependency("MovementMemberAssociation", target=lambda mma: mma.persona_id,
+            attrs=("active", ))])
     def movements(self):
         """Return movements in which this Persona is an active member
 
@@ -381,7 +553,9 @@ class Persona(Identity):
         timer.stop("Generated movement list for {}".format(self))
         return rv
 
-    @cache.memoize(timeout=REPOST_MINDSET_CACHE_DURATION)
+    @memoize_entity("identity", timeout=REPOST_MINDSET_CACHE_DURATION, depends=[
+        Dependency("MovementMemberAssociation", target=lambda mma: mma.persona_id,
+            attrs=("active", ))])
     def repost_mindsets(self):
         """Return list of mindset IDs in which this persona might post
 
@@ -424,16 +598,23 @@ class Persona(Identity):
             boolean -- True if the blog is now being followed, False if not
         """
         following = False
+        session = Session.object_session(self) or db.session
 
         try:
             self.blogs_followed.remove(ident)
             logger.info("{} is not following {} anymore".format(self, ident))
+            content.TimelineEntry.remove(self,
+                [ident.blog_id, ident.mindspace_id], session)
         except ValueError:
             self.blogs_followed.append(ident)
             following = True
             logger.info("{} is now following {}".format(self, ident))
 
-        cache.delete_memoized(self.frontpage_sources)
+            sources = [ident.blog_id]
+            if isinstance(ident, Movement) and ident.active_member(persona=self):
+                sources.append(ident.mindspace_id)
+            content.TimelineEntry.backfill(self, sources, session)
+
         return following
 
     def toggle_movement_membership(self, movement, role="member",
@@ -479,6 +660,7 @@ class Persona(Identity):
                 persona=self,
                 movement=movement,
                 role=role,
+                active=True
             )
 
         elif mma.active is False:
@@ -493,11 +675,12 @@ class Persona(Identity):
             mma.active = False
             mma.role = "left"
 
-        # Reset caches
-        cache.delete_memoized(movement.member_count)
-        cache.delete_memoized(self.movements)
-        cache.delete_memoized(self.repost_mindsets)
-        cache.delete_memoized(self.frontpage_sources)
+        # Update frontpage candidates from the movement's mindspace
+        session = Session.object_session(self) or db.session
+        if mma.active and movement in self.blogs_followed:
+            content.TimelineEntry.backfill(self, [movement.mindspace_id], session)
+        elif not mma.active:
+            content.TimelineEntry.remove(self, [movement.mindspace_id], session)
 
         return mma
 
@@ -618,28 +801,14 @@ class Movement(Identity):
         if persona not in self.members:
             self.members.append(persona)
 
-    @cache.memoize(timeout=ATTENTION_CACHE_DURATION)
-    def get_attention(self):
-        """Return a numberic value indicating attention this Movement has received
-
-        Returns:
-            integer: Attention as a positive integer
-        """
-        timer = ExecutionTimer()
-
-        thoughts = self.blog.index \
-            .filter(content.Thought.state >= 0) \
-            .filter(content.Thought.kind != "upvote").all()
-
-        thoughts += self.mindspace.index \
+    def attention_thoughts(self):
+        """Return a query for Thoughts in this Movement's blog and mindspace"""
+        ses = Session.object_session(self)
+        return ses.query(content.Thought) \
+            .filter(content.Thought.mindset_id.in_(
+                [self.blog_id, self.mindspace_id])) \
             .filter(content.Thought.state >= 0) \
-            .filter(content.Thought.kind != "upvote").all()
-
-        rv = int(sum([t.hot() for t in thoughts]) * ATTENTION_MULT)
-        timer.stop("Generated attention value for {}".format(self))
-        return rv
-
-    attention = property(get_attention)
+            .filter(content.Thought.kind != "upvote")
 
     def authorize(self, action, author_id=None):
         """Return True if this Movement authorizes `action` for `author_id`
@@ -695,7 +864,9 @@ class Movement(Identity):
         """Return URL for this movement's mindspace page"""
         return url_for("web.movement", id=self.id)
 
-    @cache.memoize(timeout=MEMBER_COUNT_CACHE_DURATION)
+    @memoize_entity("identity", timeout=MEMBER_COUNT_CACHE_DURATION, depends=[
+        Dependency("MovementMemberAssociation", target=lambda mma: mma.movement_id,
+            attrs=("active", ))])
     def member_count(self):
         """Return number of active members in this movement
 
@@ -711,17 +882,20 @@ class Movement(Identity):
         timer.stop("Generated member count for {}".format(self))
         return int(rv)
 
-    @cache.memoize(timeout=MINDSPACE_TOP_THOUGHT_CACHE_DURATION)
+    @memoize_entity("mindset", timeout=MINDSPACE_TOP_THOUGHT_CACHE_DURATION,
+        id_attr="mindspace_id", depends=[
+            Dependency("Thought", target=lambda thought: thought.mindset_id,
+                attrs=("state", ))])
     def mindspace_top_thought(self, count=15):
-        """Return count top thoughts from mindspace
+        """Return count top thoughts from mindspace as measured by Thought.hot
 
         Returns:
             list: Dicts with key 'id'
         """
+        from .helpers import top_hot
         timer = ExecutionTimer()
-        selection = self.mindspace.index.filter(content.Thought.state >= 0).all()
-        rv = [t.id for t in sorted(
-            selection, key=content.Thought.hot, reverse=True)[:count]]
+        selection = self.mindspace.index.filter(content.Thought.state >= 0)
+        rv = [t.id for t in top_hot(selection, count=count)]
         timer.stop("Generated {} mindspace top thought".format(self))
         return rv
 
@@ -741,9 +915,10 @@ class Movement(Identity):
             if thought.upvote_count() >= self.required_votes():
                 logger.info("Promoting {} to {} blog".format(thought, self))
                 clone = content.Thought.clone(thought, self, self.blog)
-                upvote = content.Upvote(id=uuid4().hex,
-                    author=self, parent=clone, state=0)
-                clone.children.append(upvote)
+                clone.votes.append(content.Vote(author=self, state=0))
+                clone._upvotes += 1
+                clone.update_hot()
+                clone.credit_attention(1)
                 thought._blogged = True
                 movement_chat.send(self, room_id=self.mindspace.id,
                     message="New promotion! Check the blog")
@@ -7,6 +7,7 @@
 
     :copyright: (c) 2013 by Vincent Ahrend.
 """
+import datetime
 import logging
 
 import content
@@ -14,17 +15,23 @@ import context
 import identity
 
 from flask.ext.rq import job
+from sqlalchemy import or_, event
+from sqlalchemy.orm.session import Session
 
-from .connections import cache, session_scope
+from . import ATTENTION_BATCH_THRESHOLD, VOTE_FLUSH_INTERVAL
+from .caching import invalidate_entity, refresh_memoized
+from .connections import db, session_scope
 from .helpers import recent_thoughts
 
 logger = logging.getLogger('nucleus')
 
 # These function names will be called in the specified (seconds) interval
 periodical = [
+    ("backfill_hot", 60 * 15),
     ("refresh_attention_cache", 60 * 15),
     ("refresh_mindspace_top_thought", 60 * 15),
     ("refresh_frontpages", 60 * 15),
+    ("flush_upvote_buffer", VOTE_FLUSH_INTERVAL),
 ]
 
 
@@ -32,18 +39,54 @@ def job_id(domain, name):
     return "-".join([domain, name])
 
 
+def delay_after_commit(instance, func, *args, **kwargs):
+    """Queue a job once `instance` has been committed to the database
+
+    Jobs that load a new object must not run before the object is committed.
+    The job is queued after the session of `instance` commits and is
+    discarded if that session rolls back.
+
+    Args:
+        instance: Mapped object
+        func: Job function
+        args, kwargs: Get passed on to func.delay
+    """
+    session = Session.object_session(instance) or db.session()
+    session.info.setdefault("after_commit_jobs", list()) \
+        .append((func, args, kwargs))
+
+
+@event.listens_for(Session, 'after_commit')
+def queue_jobs(session):
+    for func, args, kwargs in session.info.pop("after_commit_jobs", ()):
+        func.delay(*args, **kwargs)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_jobs(session):
+    session.info.pop("after_commit_jobs", None)
+
+
 @job
 def refresh_attention_cache():
-    """Calculate current attention for all known identities"""
+    """Recalculate attention for identities whose aggregate is out of date"""
     from glia import create_app
     app = create_app(log_info=False)
     with app.app_context():
         with session_scope() as session:
-            logger.info("Refreshing attention cache")
+            dirty = session.query(identity.Identity).filter(or_(
+                identity.Identity._attention_dirty == True,
+                identity.Identity._attention == None))
 
-            for ident in session.query(identity.Identity).all():
-                cache.delete_memoized(ident.get_attention)
-                ident.get_attention()
+            if dirty.count() >= ATTENTION_BATCH_THRESHOLD:
+                logger.info("Refreshing attention of all identities")
+                identity.Identity.recompute_attention_batch(session)
+            else:
+                dirty = dirty.all()
+                logger.info("Refreshing attention of {} identities".format(
+                    len(dirty)))
+                for ident in dirty:
+                    ident.recompute_attention()
 
 
 @job
@@ -58,11 +101,10 @@ def refresh_conversation_lists(dialogue_id):
             if dialogue and isinstance(dialogue, context.Dialogue):
                 logger.info("Refreshing conversation list cache for all parties in {}"
                     .format(dialogue))
-                cache.delete_memoized(dialogue.author.conversation_list)
-                cache.delete_memoized(dialogue.other.conversation_list)
-
-                dialogue.author.conversation_list()
-                dialogue.other.conversation_list()
+                refresh_memoized(dialogue.author.conversation_list,
+                    session=session)
+                refresh_memoized(dialogue.other.conversation_list,
+                    session=session)
 
 
 @job
@@ -72,17 +114,124 @@ def refresh_frontpages():
     with app.app_context():
         with session_scope() as session:
             from glia.web.helpers import generate_graph
-            logger.info("Refreshing frontpages")
 
-            content.Thought.top_thought()
+            refresh_memoized(content.Thought.top_thought)
 
-            for p in session.query(identity.Persona).all():
-                frontpage = session.query(content.Thought).filter(content.Thought.id.in_(
-                    content.Thought.top_thought(persona=p, filter_blogged=True, session=session)))
+            # Only frontpages whose timeline received new posts need refreshing
+            since = datetime.datetime.utcnow() - datetime.timedelta(
+                seconds=dict(periodical)["refresh_frontpages"])
+            persona_ids = content.TimelineEntry.updated_since(since, session)
+            logger.info("Refreshing {} frontpages".format(len(persona_ids)))
+
+            if len(persona_ids) == 0:
+                return
+
+            for p in identity.Persona.get_many(persona_ids, session=session):
+                content.TimelineEntry.trim(p.id, session)
+                frontpage = content.Thought.get_many(
+                    refresh_memoized(content.Thought.top_thought, persona=p,
+                        filter_blogged=True, session=session), session=session)
                 logging.info(frontpage)
                 generate_graph(persona=p)
 
 
+@job
+def extract_percepts(thought_id, url=None):
+    """Attach percepts to a Thought that was stored without them
+
+    Percepts are extracted from the Thought's text and from the longform
+    stored as its TextPercept."""
+    from glia import create_app
+    app = create_app(log_info=False)
+    with app.app_context():
+        with session_scope() as session:
+            thought = session.query(content.Thought).get(thought_id)
+
+            if thought is None:
+                logger.warning("Thought {} not found for percept extraction".format(
+                    thought_id))
+            else:
+                text_assocs = thought.text_percepts()
+                longform = text_assocs[0].percept.text \
+                    if len(text_assocs) > 0 else None
+
+                notifications = thought.attach_percepts(longform=longform,
+                    url=url, session=session, attach_longform=False)
+                session.add(thought)
+                session.add_all(notifications)
+                logger.info("Attached {} percepts to {}".format(
+                    len(thought.percept_assocs), thought))
+
+
+@job
+def fan_out_thought(thought_id):
+    """Add a new Thought to the timelines of all Personas receiving it"""
+    from glia import create_app
+    app = create_app(log_info=False)
+    with app.app_context():
+        with session_scope() as session:
+            thought = session.query(content.Thought).get(thought_id)
+
+            if thought is None:
+                logger.warning("Thought {} not found for fan-out".format(thought_id))
+            else:
+                content.TimelineEntry.fan_out(thought, session)
+
+
+@job
+def rebuild_timelines():
+    """Recreate frontpage timelines of all Personas from their sources"""
+    from glia import create_app
+    app = create_app(log_info=False)
+    with app.app_context():
+        with session_scope() as session:
+            logger.info("Rebuilding all timelines")
+            for p in session.query(identity.Persona).all():
+                content.TimelineEntry.rebuild(p, session)
+
+
+@job
+def rebuild_thread_index():
+    """Recreate the thread index for all Thoughts"""
+    from glia import create_app
+    app = create_app(log_info=False)
+    with app.app_context():
+        with session_scope() as session:
+            logger.info("Rebuilding thread index")
+            content.ThoughtClosure.rebuild(session)
+
+
+@job
+def migrate_upvotes():
+    """Move Upvote objects from the Thought table into the vote table"""
+    from glia import create_app
+    app = create_app(log_info=False)
+    with app.app_context():
+        with session_scope() as session:
+            logger.info("Migrating upvotes")
+            content.Vote.migrate_upvotes(session, delete_upvotes=True)
+
+
+@job
+def backfill_hot():
+    """Calculate the stored ranking score of Thoughts that are missing it"""
+    from glia import create_app
+    app = create_app(log_info=False)
+    with app.app_context():
+        with session_scope() as session:
+            content.Thought.backfill_hot(session)
+
+
+@job
+def backfill_text_percepts():
+    """Store word count and compressed text of existing TextPercepts"""
+    from glia import create_app
+    app = create_app(log_info=False)
+    with app.app_context():
+        with session_scope() as session:
+            content.TextPercept.backfill(session)
+
+
 @job
 def refresh_mindspace_top_thought():
     from glia import create_app
@@ -91,8 +240,8 @@ def refresh_mindspace_top_thought():
         with session_scope() as session:
             logger.info("Refreshing movement mindspaces")
             for movement in session.query(identity.Movement).all():
-                cache.delete_memoized(movement.mindspace_top_thought)
-                movement.mindspace_top_thought(session=session)
+                invalidate_entity("mindset", movement.mindspace_id)
+                movement.mindspace_top_thought()
 
 
 @job
@@ -102,36 +251,53 @@ def refresh_recent_thoughts():
     app = create_app(log_info=False)
     with app.app_context():
         with session_scope() as session:
-            cache.delete_memoized(recent_thoughts)
-            return recent_thoughts(session=session)
+            return refresh_memoized(recent_thoughts, session=session)
 
 
 @job
-def refresh_upvote_count(thought_id):
-    """Recalculate upvote count"""
+def check_promotion(thought_id):
+    """Check whether a thought has passed promotion threshold"""
     from glia import create_app
     app = create_app(log_info=False)
     with app.app_context():
         with session_scope() as session:
             thought = session.query(content.Thought).get(thought_id)
-            cache.delete_memoized(thought.upvote_count)
-            return thought.upvote_count(session=session)
+            promote(thought, session)
+
+
+def promote(thought, session):
+    """Promote a Thought to its movement's blog if it passed the threshold
+
+    Args:
+        thought (Thought): Thought in a movement mindspace
+        session: SA session to use
+    """
+    movement = thought.mindset.author
+    passed = movement.promotion_check(thought)
+
+    if passed:
+        session.add(movement.blog)
+        session.commit()
+
+        content.TimelineEntry.fan_out(passed, session)
+
+        invalidate_entity("mindset", movement.mindspace_id)
 
 
 @job
-def check_promotion(thought_id):
-    """Check whether a thought has passed promotion threshold"""
+def flush_upvote_buffer():
+    """Write buffered upvote counts and check resulting promotions"""
     from glia import create_app
     app = create_app(log_info=False)
     with app.app_context():
         with session_scope() as session:
-            thought = session.query(content.Thought).get(thought_id)
-
-            movement = thought.mindset.author
-            passed = movement.promotion_check(thought)
+            deltas = content.Thought.flush_upvotes(session)
 
-            if passed:
-                session.add(movement.blog)
-                session.commit()
+            for thought_id, delta in deltas.iteritems():
+                thought = session.query(content.Thought).get(thought_id)
+                if thought is None:
+                    continue
 
-                cache.delete_memoized(movement.mindspace_top_thought)
+                invalidate_entity("thought", thought.id)
+                if delta > 0 and thought.promotable():
+                    promote(thought, session)